@@ -1,57 +1,154 @@
-import os
 import time
+import asyncio
 import logging
-import requests
-from openai import OpenAI
+import subprocess
+from contextlib import asynccontextmanager
+import httpx
+from openai import AsyncOpenAI
+from transcription import TranscriptionService
+from model_manager import ModelManager
+from context_packer import estimator
+from config import getenv
 
-try:
-    import whisper  # type: ignore
-except Exception:
-    whisper = None
+
+WHISPER_SAMPLE_RATE = 16000
+
+
+def decode_audio(audio_bytes: bytes, sample_rate: int = WHISPER_SAMPLE_RATE):
+    """Decode any ffmpeg-readable audio from memory into Whisper's float32 mono input."""
+    import numpy as np
+
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0",
+        "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sample_rate),
+        "pipe:1",
+    ]
+    try:
+        out = subprocess.run(cmd, input=audio_bytes, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to decode audio: {e.stderr.decode(errors='replace')}") from e
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+class BackendLimiter:
+    """Caps concurrent requests to one LLM backend and counts queue wait and in-flight calls."""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        wait = time.monotonic() - start
+        self.requests += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "avg_wait": self.total_wait / self.requests if self.requests else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+_http_client = None
+_limiters: dict[str, BackendLimiter] = {}
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the HTTP connection pool shared by all async LLM clients of the process."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=int(getenv("LLM_MAX_CONNECTIONS", 64)),
+                max_keepalive_connections=int(getenv("LLM_MAX_KEEPALIVE", 16)),
+            ),
+            timeout=httpx.Timeout(float(getenv("LLM_TIMEOUT", 600)), connect=10.0),
+        )
+    return _http_client
+
+
+def get_backend_limiter(base_url: str, limit: int) -> BackendLimiter:
+    if base_url not in _limiters:
+        _limiters[base_url] = BackendLimiter(base_url, limit)
+    return _limiters[base_url]
+
+
+def llm_stats() -> dict:
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
 
 
 class AIClient:
-    def __init__(self, api_type=None):
+    def __init__(self, api_type=None, transcription=None):
         if api_type is None:
-            self.use_ollama = os.getenv("USE_OLLAMA", "false").lower() in ["1", "true", "yes"]
+            self.use_ollama = getenv("USE_OLLAMA", "false").lower() in ["1", "true", "yes"]
         else:
             self.use_ollama = api_type.lower() == "ollama"
 
         if self.use_ollama:
-            api_key = os.getenv("OLLAMA_API_KEY")
-            base_url = os.getenv("OLLAMA_API_BASE_URL")
-            self.model = os.getenv("OLLAMA_API_MODEL", "gemma3:27b")
+            api_key = getenv("OLLAMA_API_KEY")
+            base_url = getenv("OLLAMA_API_BASE_URL")
+            self.model = getenv("OLLAMA_API_MODEL", "gemma3:27b")
+            concurrency = int(getenv("OLLAMA_MAX_CONCURRENCY", 2))
         else:
-            api_key = os.getenv("OPENAI_API_KEY")
-            base_url = os.getenv("OPENAI_API_BASE_URL")
-            self.model = os.getenv("OPENAI_MODEL", "gpt-4o")
+            api_key = getenv("OPENAI_API_KEY")
+            base_url = getenv("OPENAI_API_BASE_URL")
+            self.model = getenv("OPENAI_MODEL", "gpt-4o")
+            concurrency = int(getenv("OPENAI_MAX_CONCURRENCY", 16))
 
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        self.async_client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=get_http_client())
+        self.limiter = get_backend_limiter(str(self.async_client.base_url), concurrency)
+        self.cancelled_requests = 0
+        self.wasted_tokens = 0
+        self.wasted_prompt_tokens = 0
+        self.timed_requests = 0
+        self.first_token_seconds = 0.0
 
-        self.unload_timeout = int(os.getenv("MODEL_UNLOAD_TIMEOUT", "1800"))
-        self.last_used_time = time.time()
-        self._whisper_model = None
+        if transcription is None:
+            transcription = TranscriptionService(self)
+        self.transcription = transcription
+        self.whisper_model_name = transcription.model_name
+        self.models = ModelManager(self)
 
-        self.load_models()
+    def ollama_url(self, path: str) -> str:
+        return str(self.async_client.base_url).rstrip("/").removesuffix("/v1") + path
 
-    def load_whisper(self):
-        if whisper is None:
-            raise RuntimeError("whisper package not installed")
+    async def load_models(self):
+        """Verify the Ollama model and, with WHISPER_WARMUP, load Whisper in a thread.
 
-        model_name = os.getenv("WHISPER_MODEL", "turbo")
-        print(f"ℹ️ Loading Whisper model {model_name}")
-        logging.info("Loading Whisper model '%s'", model_name)
-        self._whisper_model = whisper.load_model(model_name, device=os.getenv("WHISPER_DEVICE"))
-        print(f"✅ Loaded Whisper model {model_name}")
-        logging.info("Whisper model '%s' loaded", model_name)
-
-    def load_models(self):
-        self.load_whisper()
+        Called once at startup, concurrently with the Telegram connect.
+        """
+        owner = self.transcription.ai_client is self
+        if self.models.warmup and owner and self.transcription.mode == "thread":
+            await asyncio.to_thread(self.models.get_whisper)
 
         if self.use_ollama:
             try:
-                url = str(self.client.base_url).rstrip("/v1/") + "/api/tags"
-                resp = requests.get(url, timeout=10)
+                resp = await get_http_client().get(self.ollama_url("/api/tags"), timeout=10)
                 resp.raise_for_status()
                 data = resp.json()
                 names = [m.get("name") for m in data.get("models", [])]
@@ -63,60 +160,134 @@ class AIClient:
             except Exception as e:
                 raise RuntimeError(f"Failed to verify Ollama model '{self.model}': {e}")
 
-    def _maybe_unload_models(self):
-        if self.last_used_time and self.unload_timeout > 0:
-            if time.time() - self.last_used_time > self.unload_timeout:
-                if self._whisper_model is not None:
-                    self._whisper_model = None
-                    logging.info("Whisper model unloaded due to inactivity")
-
-    def transcribe(self, audio_bytes: bytes, filename: str = "audio.ogg") -> str:
-        import tempfile
-
-        self._maybe_unload_models()
-
-        if whisper is None:
-            raise RuntimeError("whisper package not installed")
-
-        if self._whisper_model is None:
-            self.load_whisper()
+    def transcribe(self, audio_bytes: bytes) -> str:
+        """Blocking transcription, use ``atranscribe`` from the event loop."""
+        model = self.models.get_whisper()
+        result = model.transcribe(audio=decode_audio(audio_bytes))
+        self.models.touch_whisper()
+        return result.get("text", "").strip()
 
-        suffix = os.path.splitext(filename)[1] or ".ogg"
-        tmp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    async def atranscribe(self, audio_bytes: bytes, timeout: float | None = None) -> str:
+        models = self.transcription.ai_client.models
+        models.start()
+        models.touch_whisper()
         try:
-            tmp.write(audio_bytes)
-            tmp.flush()
-            tmp.close()
-            result = self._whisper_model.transcribe(audio=tmp.name)
+            return await self.transcription.transcribe(audio_bytes, timeout=timeout)
         finally:
-            os.remove(tmp.name)
-
-        self.last_used_time = time.time()
-
-        return result.get("text", "").strip()
-
-    def complete(self, messages, max_tokens=None, temperature=None, top_p=None):
-        self._maybe_unload_models()
+            models.touch_whisper()
 
+    def _completion_params(self, messages, max_tokens=None, temperature=None, top_p=None):
         if max_tokens is None:
-            env_val = os.getenv("AI_MAX_TOKENS", 512)
+            env_val = getenv("AI_MAX_TOKENS", 512)
             if env_val is not None:
                 max_tokens = int(env_val)
         if temperature is None:
-            env_val = os.getenv("AI_TEMPERATURE", 0.8)
+            env_val = getenv("AI_TEMPERATURE", 0.8)
             if env_val is not None:
                 temperature = float(env_val)
         if top_p is None:
-            env_val = os.getenv("AI_TOP_P", 0.9)
+            env_val = getenv("AI_TOP_P", 0.9)
             if env_val is not None:
                 top_p = float(env_val)
 
-        response = self.client.chat.completions.create(
+        params = dict(
             model=self.model,
             messages=messages,
             max_tokens=max_tokens,
             temperature=temperature,
             top_p=top_p
         )
-        self.last_used_time = time.time()
+        keep_alive = getenv("OLLAMA_KEEP_ALIVE")
+        if self.use_ollama and keep_alive:
+            # Keeps the model and its prompt cache resident between replies.
+            params["extra_body"] = {"keep_alive": keep_alive}
+        return params
+
+    async def acomplete(self, messages, max_tokens=None, temperature=None, top_p=None, stream=False, usage=None):
+        """Return the reply text, waiting for a free slot of the backend limiter.
+
+        With ``stream`` set, returns an async iterator of text deltas that holds
+        the slot until the stream is exhausted or closed.  A ``usage`` dict is
+        filled with the token counts reported by the backend and with
+        ``first_token_seconds``, the time from sending the request to the first
+        token (the whole response when not streaming), which is dominated by
+        prompt evaluation and drops when the backend reuses its prefix cache.
+        """
+        self.models.start()
+        self.models.touch_llm()
+
+        params = self._completion_params(messages, max_tokens, temperature, top_p)
+        if stream:
+            return self._astream(params, usage)
+
+        sent = False
+        try:
+            async with self.limiter.slot():
+                start = time.monotonic()
+                sent = True
+                response = await self.async_client.chat.completions.create(**params)
+                self._record_first_token(time.monotonic() - start, usage)
+        except asyncio.CancelledError:
+            self.cancelled_requests += 1
+            if sent:
+                self._waste_prompt(params["messages"])
+            raise
+        self.models.touch_llm()
+        if usage is not None and response.usage is not None:
+            usage["prompt_tokens"] = response.usage.prompt_tokens
+            usage["completion_tokens"] = response.usage.completion_tokens
         return response.choices[0].message.content.strip()
+
+    def _waste_prompt(self, messages):
+        # The backend has evaluated (part of) the prompt of an aborted request.
+        self.wasted_prompt_tokens += sum(estimator.parts_tokens(m["content"]) for m in messages)
+
+    def _record_first_token(self, seconds: float, usage=None):
+        self.timed_requests += 1
+        self.first_token_seconds += seconds
+        if usage is not None:
+            usage["first_token_seconds"] = seconds
+
+    async def _astream(self, params, usage=None):
+        chunks = 0
+        finished = False
+        async with self.limiter.slot():
+            start = time.monotonic()
+            # The last chunk then carries the token counts, which streams omit by default.
+            response = await self.async_client.chat.completions.create(
+                **params, stream=True, stream_options={"include_usage": True}
+            )
+            try:
+                async for chunk in response:
+                    if chunk.usage is not None and usage is not None:
+                        usage["prompt_tokens"] = chunk.usage.prompt_tokens
+                        usage["completion_tokens"] = chunk.usage.completion_tokens
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if not chunks:
+                            self._record_first_token(time.monotonic() - start, usage)
+                        chunks += 1
+                        yield chunk.choices[0].delta.content
+                finished = True
+            finally:
+                # Closing the response aborts the HTTP stream, so the backend stops generating.
+                await response.close()
+                self.models.touch_llm()
+                if not finished:
+                    self.cancelled_requests += 1
+                    self.wasted_tokens += chunks
+                    self._waste_prompt(params["messages"])
+
+    def generation_stats(self) -> dict:
+        """Aborted requests, tokens thrown away with them and mean time to first token.
+
+        ``wasted_tokens`` counts streamed completion tokens, ``wasted_prompt_tokens``
+        the estimated prompt tokens of aborted requests, streamed or not.
+        """
+        return {
+            "cancelled_requests": self.cancelled_requests,
+            "wasted_tokens": self.wasted_tokens,
+            "wasted_prompt_tokens": self.wasted_prompt_tokens,
+            "avg_first_token_seconds": (
+                self.first_token_seconds / self.timed_requests if self.timed_requests else 0.0
+            ),
+        }
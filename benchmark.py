@@ -0,0 +1,661 @@
+"""Offline end-to-end benchmark of the reply pipeline.
+
+Runs process_waiting_messages against a fake Pyrogram client with synthetic
+chats and media and a local stub of the OpenAI chat completions API, then
+reports per-stage latency percentiles, allocations and throughput:
+
+    python benchmark.py
+    python benchmark.py --scenarios text_cold,pdf --iterations 50 --latency 0.2
+    python benchmark.py --json results.json
+
+Everything runs in a temporary directory; no network and no Telegram account
+are needed.  Voice messages use a stub transcription unless --whisper is given.
+"""
+import os
+import io
+import sys
+import json
+import time
+import wave
+import math
+import zlib
+import struct
+import random
+import asyncio
+import zipfile
+import argparse
+import builtins
+import importlib.util
+import tempfile
+import tracemalloc
+import contextvars
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ["text_cold", "text_warm", "stream", "photo", "pdf", "pdf_scan", "docx", "voice", "concurrent"]
+STAGES = ["fetch", "convert", "pack", "build", "llm", "send", "total"]
+# Scenarios that cannot run without an optional package.
+REQUIRES = {"pdf": "fitz", "pdf_scan": "fitz", "docx": "docx"}
+WORDS = (
+    "the quick brown fox jumps over a lazy dog while we talk about weather music travel "
+    "work plans dinner movies books and everything else people discuss in a chat"
+).split()
+
+
+# --- Stub OpenAI-compatible server -------------------------------------------------
+
+
+class StubLLMServer:
+    """Minimal HTTP/1.1 server answering /v1/chat/completions after a fixed delay.
+
+    ``latency`` stands for prompt evaluation before the first token,
+    ``token_delay`` for the time between streamed tokens.
+    """
+
+    def __init__(self, latency: float, token_delay: float, reply_tokens: int):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.reply_tokens = reply_tokens
+        self.requests = 0
+        self._server = None
+        self.port = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                await self._respond(writer, json.loads(body or b"{}"))
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Keep-alive connections of the bot's pool end with the benchmark.
+            pass
+        finally:
+            writer.close()
+
+    def _reply_words(self):
+        return [random.choice(WORDS) for _ in range(self.reply_tokens)]
+
+    async def _respond(self, writer, request: dict):
+        self.requests += 1
+        prompt_tokens = len(json.dumps(request.get("messages", []))) // 4
+        model = request.get("model", "stub")
+        await asyncio.sleep(self.latency)
+        words = self._reply_words()
+        if not request.get("stream"):
+            body = json.dumps({
+                "id": f"stub-{self.requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(words),
+                    "total_tokens": prompt_tokens + len(words),
+                },
+            }).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+            return
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            chunk = {
+                "id": f"stub-{self.requests}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": (" " if i else "") + word}, "finish_reason": None}],
+            }
+            self._write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode())
+            await writer.drain()
+        if request.get("stream_options", {}).get("include_usage"):
+            chunk = {
+                "id": f"stub-{self.requests}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(words),
+                    "total_tokens": prompt_tokens + len(words),
+                },
+            }
+            self._write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode())
+        self._write_chunk(writer, b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    def _write_chunk(writer, data: bytes):
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+
+# --- Synthetic media ----------------------------------------------------------------
+
+
+def make_png(width: int = 1600, height: int = 1200, block: int = 8) -> bytes:
+    """Blocky noise, large enough that the image stage has to downsize it."""
+    rnd = random.Random(1)
+    raw = bytearray()
+    for _ in range(height // block):
+        small = rnd.randbytes(width // block * 3)
+        row = b"".join(small[i:i + 3] * block for i in range(0, len(small), 3))
+        raw += (b"\x00" + row) * block
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    header = struct.pack(">IIBBBBB", width, height // block * block, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(bytes(raw), 6)) + chunk(b"IEND", b"")
+
+
+def make_pdf(pages: int = 5, text: bool = True) -> bytes:
+    """A letter-size PDF; with ``text`` every page has a text layer."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for p in range(pages):
+        lines = []
+        if text:
+            rnd = random.Random(p)
+            for i in range(40):
+                words = " ".join(rnd.choice(WORDS) for _ in range(12))
+                lines.append(f"BT /F1 11 Tf 50 {740 - i * 17} Td ({words}) Tj ET")
+        else:
+            for i in range(20):
+                lines.append(f"0.{i % 10} g {50 + i * 20} {100 + i * 25} 200 150 re f")
+        stream = "\n".join(lines)
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        content = len(objects)
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content} 0 R >>"
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(f"{i} 0 obj\n{obj}\nendobj\n".encode("latin-1"))
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+def make_docx(paragraphs: int = 200) -> bytes:
+    rnd = random.Random(2)
+    body = "".join(
+        f"<w:p><w:r><w:t>{' '.join(rnd.choice(WORDS) for _ in range(20))}</w:t></w:r></w:p>"
+        for _ in range(paragraphs)
+    )
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr(
+            "[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            "</Types>",
+        )
+        z.writestr(
+            "_rels/.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="word/document.xml"/></Relationships>',
+        )
+        z.writestr(
+            "word/document.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f"<w:body>{body}</w:body></w:document>",
+        )
+    return out.getvalue()
+
+
+def make_wav(seconds: float = 5.0, rate: int = 16000) -> bytes:
+    out = io.BytesIO()
+    with wave.open(out, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"".join(
+            struct.pack("<h", int(8000 * math.sin(2 * math.pi * 440 * i / rate)))
+            for i in range(int(seconds * rate))
+        ))
+    return out.getvalue()
+
+
+# --- Fake Pyrogram client -----------------------------------------------------------
+
+
+class FakeClient:
+    """The subset of pyrogram.Client used by bot_utils, backed by in-memory chats."""
+
+    def __init__(self, download_latency: float = 0.0):
+        self.download_latency = download_latency
+        self.chats: dict[int, list] = {}
+        self._next_id = 1
+        self._uid = 0
+        self.sent = 0
+
+    def unique_id(self, prefix: str) -> str:
+        self._uid += 1
+        return f"{prefix}{self._uid}"
+
+    def message(self, chat_id: int, text=None, outgoing=False, **media):
+        msg = SimpleNamespace(
+            id=self._next_id,
+            chat=SimpleNamespace(id=chat_id, title=f"Group {chat_id}" if chat_id < 0 else None),
+            from_user=SimpleNamespace(first_name="Bench", username="bench", id=chat_id),
+            text=text,
+            caption=None,
+            photo=media.get("photo"),
+            document=media.get("document"),
+            voice=media.get("voice"),
+            audio=None,
+            video_note=None,
+            outgoing=outgoing,
+            payload=media.get("payload"),
+            mentioned=False,
+            reply_to_message=None,
+        )
+        self._next_id += 1
+        self.chats.setdefault(chat_id, []).append(msg)
+        return msg
+
+    def seed_chat(self, chat_id: int, length: int, rnd: random.Random):
+        for i in range(length):
+            words = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 40)))
+            self.message(chat_id, words, outgoing=i % 2 == 1)
+
+    async def get_chat_history(self, chat_id: int, limit: int = 0):
+        for msg in reversed(self.chats.get(chat_id, [])[-limit:]):
+            yield msg
+
+    async def get_discussion_replies(self, chat_id: int, topic_id: int, limit: int = 0):
+        async for msg in self.get_chat_history(chat_id, limit):
+            yield msg
+
+    async def download_media(self, msg, in_memory: bool = False):
+        if self.download_latency:
+            await asyncio.sleep(self.download_latency)
+        return io.BytesIO(msg.payload)
+
+    async def send_chat_action(self, chat_id, action):
+        pass
+
+    async def send_message(self, chat_id: int, text: str):
+        self.sent += 1
+        return self.message(chat_id, text, outgoing=True)
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str):
+        pass
+
+    async def delete_messages(self, chat_id: int, message_ids):
+        pass
+
+
+# --- Stage timing -------------------------------------------------------------------
+
+_stages = contextvars.ContextVar("stages")
+
+
+def timed(name: str, func):
+    """Wrap a bot_utils function so its time is added to the running reply's stages."""
+    if asyncio.iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _add_stage(name, time.perf_counter() - start)
+    else:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _add_stage(name, time.perf_counter() - start)
+    return wrapper
+
+
+def _add_stage(name: str, seconds: float):
+    stages = _stages.get(None)
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+def percentile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * q
+    f = int(k)
+    c = min(f + 1, len(ordered) - 1)
+    return ordered[f] + (ordered[c] - ordered[f]) * (k - f)
+
+
+# --- Scenarios ----------------------------------------------------------------------
+
+
+class Bench:
+    def __init__(self, args):
+        import bot_utils
+        from ai_client import AIClient
+        from history_cache import HistoryCache
+
+        self.args = args
+        self.bot_utils = bot_utils
+        self.HistoryCache = HistoryCache
+        self.client = FakeClient(args.download_latency)
+        self.ai_client = AIClient()
+        self.rnd = random.Random(args.seed)
+        self.history_cache = HistoryCache()
+        self.next_chat = 1000
+        self.media = {
+            "photo": make_png(),
+            "pdf": make_pdf(text=True),
+            "pdf_scan": make_pdf(text=False),
+            "docx": make_docx(),
+            "voice": make_wav(),
+        }
+        if not args.whisper:
+            self.ai_client.atranscribe = self._fake_transcribe
+
+        bot_utils.fetch_history = timed("fetch", bot_utils.fetch_history)
+        bot_utils.prepare_entries = timed("convert", bot_utils.prepare_entries)
+        bot_utils.pack_context = timed("pack", bot_utils.pack_context)
+        bot_utils.build_openai_messages = timed("build", bot_utils.build_openai_messages)
+        bot_utils.send_message_in_topic = timed("send", bot_utils.send_message_in_topic)
+        bot_utils.stream_reply = timed("llm", bot_utils.stream_reply)
+        self.ai_client.acomplete = self._timed_acomplete(self.ai_client.acomplete)
+
+    def _timed_acomplete(self, acomplete):
+        async def wrapper(*args, stream=False, **kwargs):
+            if stream:
+                return await acomplete(*args, stream=True, **kwargs)
+            return await timed("llm", acomplete)(*args, **kwargs)
+        return wrapper
+
+    async def _fake_transcribe(self, audio_bytes: bytes, timeout=None) -> str:
+        await asyncio.sleep(self.args.whisper_latency)
+        return "this is a synthetic transcript of a voice message"
+
+    def new_chat(self) -> int:
+        self.next_chat += 1
+        self.client.seed_chat(self.next_chat, self.args.history, self.rnd)
+        return self.next_chat
+
+    def media_message(self, chat_id: int, kind: str):
+        data = self.media[kind]
+        if kind == "photo":
+            return self.client.message(
+                chat_id, photo=SimpleNamespace(file_unique_id=self.client.unique_id("p")), payload=data
+            )
+        if kind == "voice":
+            return self.client.message(
+                chat_id, voice=SimpleNamespace(file_unique_id=self.client.unique_id("v")), payload=data
+            )
+        mime, name = {
+            "pdf": ("application/pdf", "report.pdf"),
+            "pdf_scan": ("application/pdf", "scan.pdf"),
+            "docx": ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "notes.docx"),
+        }[kind]
+        uid = self.client.unique_id("d")
+        document = SimpleNamespace(file_unique_id=uid, file_id=uid, mime_type=mime, file_name=name)
+        return self.client.message(chat_id, document=document, payload=data)
+
+    async def reply(self, chat_id: int, msgs) -> dict:
+        stages = {}
+
+        async def run():
+            _stages.set(stages)
+            start = time.perf_counter()
+            await self.bot_utils.process_waiting_messages(
+                self.client, chat_id, msgs, self.ai_client, history_cache=self.history_cache
+            )
+            stages["total"] = time.perf_counter() - start
+
+        await asyncio.create_task(run())
+        return stages
+
+    async def iteration(self, scenario: str, warm_chat: int) -> dict:
+        if scenario == "text_cold":
+            chat_id = self.new_chat()
+            msg = self.client.message(chat_id, "how was your day?")
+        elif scenario in ("text_warm", "stream"):
+            chat_id = warm_chat
+            msg = self.client.message(chat_id, "and what about tomorrow?")
+        else:
+            chat_id = self.new_chat()
+            msg = self.media_message(chat_id, scenario)
+        return await self.reply(chat_id, [msg])
+
+    async def run_scenario(self, scenario: str, iterations: int) -> list[dict]:
+        os.environ["AI_STREAM"] = "true" if scenario == "stream" else "false"
+        warm_chat = self.new_chat()
+        samples = []
+        for i in range(iterations):
+            samples.append(await self.iteration(scenario, warm_chat))
+        return samples
+
+    async def run_concurrent(self) -> dict:
+        """``chats`` chats reply ``iterations`` times each, all at once."""
+        os.environ["AI_STREAM"] = "false"
+        chats = [self.new_chat() for _ in range(self.args.chats)]
+
+        async def chat_loop(chat_id):
+            samples = []
+            for _ in range(self.args.iterations):
+                samples.append(await self.reply(chat_id, [self.client.message(chat_id, "tell me more")]))
+            return samples
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(chat_loop(c) for c in chats))
+        wall = time.perf_counter() - start
+        samples = [s for r in results for s in r]
+        return {"samples": samples, "wall": wall}
+
+    async def allocations(self, scenario: str) -> dict:
+        """Peak and retained traced memory of a few replies of a scenario."""
+        if scenario == "concurrent":
+            return {}
+        os.environ["AI_STREAM"] = "true" if scenario == "stream" else "false"
+        warm_chat = self.new_chat()
+        await self.iteration(scenario, warm_chat)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            for _ in range(self.args.alloc_iterations):
+                await self.iteration(scenario, warm_chat)
+            current, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        allocated = sum(s.size_diff for s in after.compare_to(before, "filename") if s.size_diff > 0)
+        return {
+            "peak_kb": (peak - base) / 1024,
+            "retained_kb": (current - base) / 1024,
+            "allocated_kb_per_reply": allocated / 1024 / self.args.alloc_iterations,
+        }
+
+
+def summarize(samples: list[dict]) -> dict:
+    # Replies that failed inside process_waiting_messages never reached the LLM.
+    samples = [s for s in samples if "llm" in s]
+    result = {}
+    for stage in STAGES:
+        values = [s[stage] * 1000 for s in samples if stage in s]
+        if values:
+            result[stage] = {
+                "p50": percentile(values, 0.5),
+                "p90": percentile(values, 0.9),
+                "p99": percentile(values, 0.99),
+                "max": max(values),
+            }
+    return result
+
+
+def report(name: str, result: dict, out):
+    out(f"\n{name}: {result['replies']} replies, {result['throughput']:.1f} replies/s")
+    if result["failed"]:
+        out(f"  ⛔ {result['failed']} replies failed, run with --verbose to see why")
+    out(f"  {'stage':<8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for stage, values in result["stages"].items():
+        out(
+            f"  {stage:<8} {values['p50']:>9.2f} {values['p90']:>9.2f} "
+            f"{values['p99']:>9.2f} {values['max']:>9.2f}"
+        )
+    alloc = result.get("allocations")
+    if alloc:
+        out(
+            f"  memory   peak {alloc['peak_kb']:.0f} KB, retained {alloc['retained_kb']:.0f} KB, "
+            f"allocated {alloc['allocated_kb_per_reply']:.0f} KB per reply"
+        )
+
+
+def setup_environment(args, workdir: str, port: int):
+    """Point the bot at the stub server and a throwaway instance directory."""
+    os.chdir(workdir)
+    os.makedirs("system", exist_ok=True)
+    with open(os.path.join("system", "bench.txt"), "w", encoding="utf-8") as f:
+        f.write("You are a friendly person chatting with a friend. Keep replies short.")
+    os.environ.update({
+        "INSTANCE_NAME": "bench",
+        "USE_OLLAMA": "false",
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_API_BASE_URL": f"http://127.0.0.1:{port}/v1",
+        "OPENAI_MODEL": "stub",
+        "HISTORY_LIMIT": str(args.history_limit),
+        "PROMPT_LAYOUT": args.layout,
+        "STREAM_EDIT_INTERVAL": "0",
+    })
+
+
+async def main(args):
+    server = StubLLMServer(args.latency, args.token_delay, args.reply_tokens)
+    await server.start()
+    real_print = builtins.print
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        setup_environment(args, workdir, server.port)
+        sys.path.insert(0, REPO_DIR)
+        if not args.verbose:
+            builtins.print = lambda *a, **k: None
+        try:
+            import bot_utils
+
+            bot_utils.init_caches(os.path.join(workdir, "data", "bench"))
+            bench = Bench(args)
+            results = {}
+            for scenario in args.scenarios:
+                module = REQUIRES.get(scenario) or ("whisper" if scenario == "voice" and args.whisper else None)
+                if module and importlib.util.find_spec(module) is None:
+                    real_print(f"⛔ Skipping {scenario}: {module} is not installed")
+                    continue
+                if scenario == "concurrent":
+                    run = await bench.run_concurrent()
+                    samples, wall = run["samples"], run["wall"]
+                else:
+                    start = time.perf_counter()
+                    samples = await bench.run_scenario(scenario, args.iterations)
+                    wall = time.perf_counter() - start
+                result = {
+                    "replies": len(samples),
+                    "failed": sum(1 for s in samples if "llm" not in s),
+                    "throughput": len(samples) / wall if wall else 0.0,
+                    "stages": summarize(samples),
+                }
+                if args.alloc_iterations:
+                    result["allocations"] = await bench.allocations(scenario)
+                results[scenario] = result
+                report(scenario, result, real_print)
+        finally:
+            builtins.print = real_print
+            from ai_client import get_http_client
+
+            await get_http_client().aclose()
+            await server.close()
+            os.chdir(cwd)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print(f"ℹ️ Results written to {args.json}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the reply pipeline")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--iterations", type=int, default=20, help="replies per scenario (per chat for concurrent)")
+    parser.add_argument("--chats", type=int, default=20, help="chats replying at once in the concurrent scenario")
+    parser.add_argument("--history", type=int, default=60, help="messages in each synthetic chat")
+    parser.add_argument("--history-limit", type=int, default=21, help="HISTORY_LIMIT of the bot")
+    parser.add_argument("--layout", default="default", choices=["default", "stable"], help="PROMPT_LAYOUT")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub LLM seconds before the first token")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="stub LLM seconds between streamed tokens")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="words in each stub reply")
+    parser.add_argument("--download-latency", type=float, default=0.0, help="fake Telegram download delay")
+    parser.add_argument("--whisper", action="store_true", help="transcribe voice with the real Whisper model")
+    parser.add_argument("--whisper-latency", type=float, default=0.5, help="stub transcription delay")
+    parser.add_argument("--alloc-iterations", type=int, default=3, help="traced replies per scenario, 0 to skip")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own output")
+    args = parser.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    if args.json:
+        # The benchmark runs inside a temporary directory.
+        args.json = os.path.abspath(args.json)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    random.seed(1)
+    asyncio.run(main(parse_args()))
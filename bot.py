@@ -0,0 +1,199 @@
+import os
+import asyncio
+from pyrogram import Client, filters
+from pyrogram.types import Message
+from pyrogram.enums import ChatAction
+from pyrogram.handlers import MessageHandler, EditedMessageHandler
+from ai_client import AIClient, llm_stats
+from bot_utils import process_waiting_messages, general_system_prompt
+from history_cache import HistoryCache
+from scheduler import ChatScheduler
+from prompt_utils import load_cached_weather, refresh_weather_periodically
+from config import getenv, activate, instance_env
+from metrics import metrics, export_snapshots
+from log_utils import log_stats
+
+
+def load_id_list(path: str) -> set[int]:
+    ids: set[int] = set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and line.lstrip("-").isdigit():
+                    ids.add(int(line))
+    except FileNotFoundError:
+        pass
+    return ids
+
+
+def get_topic_id(msg: Message) -> int | None:
+    topic = getattr(msg, "reply_to_top_message_id", None)
+    if not topic:
+        topic = getattr(msg, "message_thread_id", None)
+    if not topic and msg.reply_to_message:
+        topic = getattr(msg.reply_to_message, "reply_to_top_message_id", None)
+        if not topic:
+            topic = getattr(msg.reply_to_message, "message_thread_id", None)
+    return topic
+
+
+def get_chat_key(msg: Message):
+    if int(msg.chat.id) < 0:
+        return (msg.chat.id, get_topic_id(msg))
+    return msg.chat.id
+
+
+class Bot:
+    """One instance: its Telegram client, AI client, history cache and scheduler.
+
+    ``env`` holds the settings of the instance when several instances share a
+    process (see host.py); they are active in every task the instance starts.
+    Without it the process environment is used.  ``transcription`` is the
+    service of another instance's AIClient to share its Whisper model.
+    """
+
+    def __init__(self, name: str, env: dict | None = None, transcription=None):
+        self.name = name
+        self.env = env
+        self._tasks = []
+        with instance_env(env):
+            # Fail at startup rather than on the first message.
+            general_system_prompt()
+            load_cached_weather()
+            self.client = Client(
+                name=getenv("APP_NAME"),
+                api_id=int(getenv("API_ID")),
+                api_hash=getenv("API_HASH")
+            )
+            self.ai_client = AIClient(transcription=transcription)
+            self.excluded_users = load_id_list(os.path.join("data", name, "excluded.txt"))
+            self.included_groups = load_id_list(os.path.join("data", name, "included.txt"))
+            self.history_cache = HistoryCache()
+            self.scheduler = ChatScheduler(self.process_batch)
+            metrics.gauge("scheduler", self.scheduler.stats)
+            metrics.gauge("history_cache", self.history_cache.stats)
+            metrics.gauge("generation", self.ai_client.generation_stats)
+            metrics.gauge("models", self.ai_client.models.stats)
+        metrics.gauge("llm", llm_stats, shared=True)
+        metrics.gauge("transcription", self.ai_client.transcription.stats, shared=True)
+        metrics.gauge("logging", log_stats, shared=True)
+
+        self.client.add_handler(MessageHandler(self.handle_message, filters.private & filters.incoming))
+        self.client.add_handler(MessageHandler(self.handle_group_message, filters.group & filters.incoming))
+        self.client.add_handler(
+            MessageHandler(self.handle_outgoing_message, filters.outgoing & (filters.private | filters.group))
+        )
+        self.client.add_handler(EditedMessageHandler(self.handle_edited_message, filters.private | filters.group))
+
+    async def start(self):
+        """Connect and verify the models concurrently, then start background tasks.
+
+        Activates the instance settings for the calling task, so in host mode
+        each instance must be started in its own task.
+        """
+        activate(self.env)
+        # The Telegram connect and the model checks do not depend on each other.
+        results = await asyncio.gather(self.client.start(), self.ai_client.load_models(), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            if self.client.is_connected:
+                await self.client.stop()
+            raise errors[0]
+        self._tasks.append(asyncio.create_task(refresh_weather_periodically()))
+        self._tasks.append(asyncio.create_task(export_snapshots(os.path.join("data", self.name, "metrics.json"))))
+        self.ai_client.models.start()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.ai_client.models.close()
+        if self.client.is_connected:
+            await self.client.stop()
+
+    async def process_batch(self, chat_key, job):
+        with metrics.span("reply"):
+            await process_waiting_messages(
+                self.client,
+                chat_key,
+                job.messages,
+                self.ai_client,
+                reply_to=job.reply_to,
+                history_cache=self.history_cache,
+                job=job,
+            )
+
+    async def handle_message(self, client: Client, message: Message):
+        user_id = message.from_user.id
+
+        if user_id in self.excluded_users:
+            print(f"Skipping excluded user: {user_id}")
+            return
+
+        username = message.from_user.username
+        if username and username.lower().endswith("_bot"):
+            print(f"Skipping bot user: {username}")
+            return
+
+        if int(user_id) < 0:
+            print(f"Skipping group/channel: {user_id}")
+            return
+
+        if int(message.chat.id) < 0:
+            print(f"Skipping group/channel: {message.chat.id}")
+            return
+
+        print(
+            f"🤖 Got message from {message.from_user.first_name} ({user_id}): {message.text or 'Non-text message'}"
+        )
+        self.history_cache.add_message(user_id, message)
+
+        delay = int(getenv("NEXT_MESSAGE_WAIT_TIME", 10))
+        if self.scheduler.submit(user_id, message, delay):
+            await client.send_chat_action(user_id, ChatAction.TYPING)
+
+    async def handle_group_message(self, client: Client, message: Message):
+        chat_id = message.chat.id
+        chat_name = message.chat.title
+        if chat_id not in self.included_groups:
+            print(f"Skipping not included group: {chat_id}: {chat_name}")
+            return
+        if not message.from_user:
+            print(f"Skipping not user message in group: {chat_id}")
+            return
+
+        username = message.from_user.username
+        if username and username.lower().endswith("_bot"):
+            print(f"Skipping bot user in group: {username}")
+            return
+
+        text = message.text or message.caption or ""
+        bot_username = client.me.username if client.me else ""
+        mentioned = False
+        if bot_username and f"@{bot_username.lower()}" in text.lower():
+            mentioned = True
+        if message.mentioned: #or (message.reply_to_message and message.reply_to_message.from_user and message.reply_to_message.from_user.id == client.me.id):
+            mentioned = True
+
+        print(
+            f"🤖 Got group message in {chat_id} from {message.from_user.first_name} ({message.from_user.id}): {text or 'Non-text message'}"
+        )
+
+        topic_id = get_topic_id(message)
+
+        chat_key = (chat_id, topic_id)
+        self.history_cache.add_message(chat_key, message)
+
+        delay = int(getenv("NEXT_MESSAGE_WAIT_TIME", 10)) if mentioned else int(getenv("GROUP_MESSAGE_WAIT_TIME", 60))
+        print(f"Delaying group message in {chat_id}:{topic_id} by {delay} seconds")
+        # A mention reschedules the pending batch of the topic with the shorter delay.
+        if self.scheduler.submit(chat_key, message, delay, reply_target=mentioned) or mentioned:
+            await client.send_chat_action(chat_id, ChatAction.TYPING)
+
+    async def handle_outgoing_message(self, client: Client, message: Message):
+        # Messages written by hand from another device still belong to the context.
+        self.history_cache.add_message(get_chat_key(message), message)
+
+    async def handle_edited_message(self, client: Client, message: Message):
+        self.history_cache.replace_message(get_chat_key(message), message)
@@ -2,48 +2,177 @@ import os
 import json
 import asyncio
 import base64
+import time
 import random
 from io import BytesIO
 from pyrogram import Client
 from pyrogram import raw
 from pyrogram.types import Message
+from pyrogram.errors import FloodWait, MessageNotModified
 from ai_client import AIClient
+from history_cache import HistoryCache, make_entry
+from prompt_store import PromptStore
+from context_packer import pack_context, stable_candidates, estimator, use_fallback
+from pdf_pipeline import convert_pdf, pdf_settings
+from image_utils import image_settings, normalize_image
+from media_cache import MediaPayloadCache, payload_key
+from cache_manager import CacheManager, format_usage
+from transcript_cache import TranscriptCache
 from pyrogram.enums import ChatAction
-from prompt_utils import enhance_system_prompt
-from docx import Document
-import fitz
+from prompt_utils import enhance_system_prompt, get_volatile_context
+from config import getenv
+from metrics import metrics
 
 SYSTEM_PROMPTS_DIR = "prompts"
 GROUP_PROMPTS_SUBDIR = "groups"
 SYSTEM_DIR = "system"
-INSTANCE_NAME = os.getenv("INSTANCE_NAME")
-if not INSTANCE_NAME:
-    raise ValueError("INSTANCE_NAME not set")
-with open(os.path.join(SYSTEM_DIR, f"{INSTANCE_NAME}.txt"), "r", encoding="utf-8") as f:
-    GENERAL_SYSTEM_PROMPT = f.read().strip()
 
-CACHE_DIR = os.path.join("data", INSTANCE_NAME, "cache")
-os.makedirs(CACHE_DIR, exist_ok=True)
+prompt_store = PromptStore()
+
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "gif", "png", "webp", "avif")
+
+# Shared by every instance of the process, see init_caches.
+cache_manager = None
+media_cache = None
+transcript_cache = None
+
+
+def init_caches(data_dir: str):
+    """Open the media payload and transcript caches under ``data_dir``."""
+    global cache_manager, media_cache, transcript_cache
+    cache_manager = CacheManager(os.path.join(data_dir, "cache"))
+    cache_manager.compact()
+    print(f"ℹ️ Cache usage: {format_usage(cache_manager.usage())}")
+    media_cache = MediaPayloadCache(cache_manager)
+    transcript_cache = TranscriptCache(os.path.join(data_dir, "transcripts.sqlite3"))
+    metrics.gauge("cache", cache_manager.usage, shared=True)
+    metrics.gauge("media_cache", media_cache.stats, shared=True)
+    metrics.gauge("transcript_cache", transcript_cache.stats, shared=True)
+    metrics.gauge("prompt_store", prompt_store.stats, shared=True)
+
+
+async def close_caches():
+    """Write what the caches still hold in memory, on shutdown."""
+    if cache_manager is not None:
+        await cache_manager.flush()
+    if transcript_cache is not None:
+        await asyncio.to_thread(transcript_cache.flush)
+
+
+def instance_name() -> str:
+    name = getenv("INSTANCE_NAME")
+    if not name:
+        raise ValueError("INSTANCE_NAME not set")
+    return name
+
+
+def general_system_prompt() -> str:
+    path = os.path.join(SYSTEM_DIR, f"{instance_name()}.txt")
+    prompt = prompt_store.get(path)
+    if prompt is None:
+        raise FileNotFoundError(f"System prompt {path} not found")
+    return prompt
+
 
 def get_system_prompt(chat_id: int, name: str) -> str:
     if chat_id < 0:
         path = os.path.join(
-            SYSTEM_PROMPTS_DIR, INSTANCE_NAME, GROUP_PROMPTS_SUBDIR, f"{chat_id}.txt"
+            SYSTEM_PROMPTS_DIR, instance_name(), GROUP_PROMPTS_SUBDIR, f"{chat_id}.txt"
         )
     else:
-        path = os.path.join(SYSTEM_PROMPTS_DIR, INSTANCE_NAME, f"{chat_id}.txt")
+        path = os.path.join(SYSTEM_PROMPTS_DIR, instance_name(), f"{chat_id}.txt")
 
-    if os.path.exists(path):
+    custom = prompt_store.get(path)
+    if custom is not None:
         print(f"ℹ️ Using custom system prompt for chat {chat_id}")
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read().strip()
+        return custom
 
     if chat_id < 0:
-        return GENERAL_SYSTEM_PROMPT + f"\nThe group's name is {name}."
+        return general_system_prompt() + f"\nThe group's name is {name}."
+
+    return general_system_prompt() + f"\nThe other person's name is {name}."
+
+def media_kind(msg: Message) -> str | None:
+    """Return which kind of media a message carries, using metadata only."""
+    if msg.photo:
+        return "photo"
+    if msg.document and msg.document.mime_type:
+        mime_type = msg.document.mime_type
+        fname = (msg.document.file_name or "").lower()
+        if mime_type.startswith("image/") and fname.endswith(IMAGE_EXTENSIONS):
+            return "image"
+        if mime_type == "application/pdf" or fname.endswith(".pdf"):
+            return "pdf"
+        if mime_type.startswith("application/vnd.openxmlformats") or fname.endswith(".docx"):
+            return "docx"
+    return None
+
+
+def media_placeholder(msg: Message, kind: str) -> str:
+    if kind == "photo":
+        return "[photo]"
+    name = msg.document.file_name or "unnamed"
+    if kind == "image":
+        return f"[image: {name}]"
+    return f"[{kind.upper()} document: {name}]"
+
+
+def image_part(data: bytes, mime_type: str, document: bool = False) -> dict:
+    encoded = base64.b64encode(data).decode()
+    part = {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded}"}}
+    if document:
+        part["document"] = True
+    return part
+
+
+def docx_text(data: bytes) -> str:
+    from docx import Document
+
+    doc = Document(BytesIO(data))
+    return "\n".join(p.text for p in doc.paragraphs)
+
+
+def media_params(kind: str) -> dict:
+    """Settings that change the payload of a media kind and therefore its cache key."""
+    if kind in ("photo", "image"):
+        return {"kind": "image", **image_settings()}
+    if kind == "pdf":
+        return {"kind": "pdf", **pdf_settings()}
+    return {"kind": kind}
+
+
+async def load_media_parts(client: Client, msg: Message, kind: str, uid: str, mime_type: str):
+    """Return ready-to-send parts of an image, PDF or DOCX, downloading only on a cache miss."""
+    key = payload_key(uid, media_params(kind))
+    cached = await media_cache.aget(key)
+    if cached is not None:
+        return cached
+
+    with metrics.span("download"):
+        data = (await client.download_media(msg, in_memory=True)).getvalue()
+    if kind in ("photo", "image"):
+        with metrics.span("image"):
+            image, image_mime = await asyncio.to_thread(normalize_image, data, mime_type)
+            parts = [await asyncio.to_thread(image_part, image, image_mime)]
+    elif kind == "pdf":
+        print("ℹ️ Converting PDF with PyMuPDF")
+        with metrics.span("pdf"):
+            result_kind, result = await convert_pdf(data)
+            if result_kind == "text":
+                parts = [{"type": "text", "text": result, "document": True}]
+            else:
+                parts = [await asyncio.to_thread(image_part, page, "image/jpeg", True) for page in result]
+    else:
+        print("ℹ️ Extracting text from DOCX file")
+        with metrics.span("docx"):
+            text_content = await asyncio.to_thread(docx_text, data)
+        parts = [{"type": "text", "text": text_content, "document": True}] if text_content else []
+    await media_cache.aput(key, parts)
+    print(f"✅ Cached {kind} payload {key}")
+    return parts
 
-    return GENERAL_SYSTEM_PROMPT + f"\nThe other person's name is {name}."
 
-async def message_to_content(client: Client, msg: Message, ai_client: AIClient):
+async def message_to_content(client: Client, msg: Message, ai_client: AIClient, include_media: bool = True):
     parts = []
     text = msg.text or msg.caption
 
@@ -51,77 +180,50 @@ async def message_to_content(client: Client, msg: Message, ai_client: AIClient):
         return 0
 
     if msg.voice or msg.audio or msg.video_note:
-        try:
-            print("ℹ️ Got audio message, trying to transcript with Whisper")
-            media = await client.download_media(msg, in_memory=True)
-            transcript = ai_client.transcribe(media.getvalue())
-            if transcript:
-                print(f"ℹ️ Got transcription: {transcript}")
-                text = (text + "\n" if text else "") + transcript
-        except Exception as e:
-            print(f"⛔ Whisper error: {e}")
+        uid = (msg.voice or msg.audio or msg.video_note).file_unique_id
+        transcript = transcript_cache.get(uid, ai_client.whisper_model_name)
+        if transcript is None:
+            try:
+                print("ℹ️ Got audio message, trying to transcript with Whisper")
+                with metrics.span("download"):
+                    media = await client.download_media(msg, in_memory=True)
+                with metrics.span("transcribe"):
+                    transcript = await ai_client.atranscribe(media.getvalue())
+                transcript_cache.put(uid, ai_client.whisper_model_name, transcript)
+            except Exception as e:
+                print(f"⛔ Whisper error: {e}")
+        if transcript:
+            print(f"ℹ️ Got transcription: {transcript}")
+            text = (text + "\n" if text else "") + transcript
 
     if text:
         parts.append({"type": "text", "text": text})
 
-    media = None
-    mime_type = "image/jpeg"
-    if msg.photo:
-        media = await client.download_media(msg, in_memory=True)
+    kind = media_kind(msg)
+    if kind and not include_media:
+        parts.append({"type": "text", "text": media_placeholder(msg, kind)})
+        return parts
+
+    if kind:
+        if msg.photo:
+            uid = msg.photo.file_unique_id
+            mime_type = "image/jpeg"
+        else:
+            uid = msg.document.file_unique_id or msg.document.file_id
+            mime_type = msg.document.mime_type
+            print(f"ℹ️ Got document with mime type {mime_type}")
+        parts.extend(await load_media_parts(client, msg, kind, uid, mime_type))
     elif msg.document and msg.document.mime_type:
         mime_type = msg.document.mime_type
-        print(f"ℹ️ Got document with mime type {mime_type}")
         fname = msg.document.file_name or ""
-        if mime_type.startswith("image/") and fname.lower().endswith(("jpg", "jpeg", "gif", "png", "webp", "avif")):
-            media = await client.download_media(msg, in_memory=True)
-        elif mime_type == "application/pdf" or fname.lower().endswith(".pdf"):
-            uid = msg.document.file_unique_id or msg.document.file_id
-            doc_dir = os.path.join(CACHE_DIR, uid)
-            os.makedirs(doc_dir, exist_ok=True)
-            image_files = sorted([f for f in os.listdir(doc_dir) if f.endswith(".jpg")])
-            if not image_files:
-                print("ℹ️ Converting PDF to images with PyMuPDF")
-                pdf_bytes = await client.download_media(msg, in_memory=True)
-                pdf_bytes = pdf_bytes.getvalue()
-                with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-                    for i, page in enumerate(doc):
-                        pix = page.get_pixmap()
-                        out_path = os.path.join(doc_dir, f"page_{i+1}.jpg")
-                        with open(out_path, "wb") as f:
-                            f.write(pix.tobytes("jpg"))
-                        print(f"✅ Saved PDF page {i+1} to {out_path}")
-                        image_files.append(f"page_{i+1}.jpg")
-            for img in image_files:
-                with open(os.path.join(doc_dir, img), "rb") as f:
-                    encoded = base64.b64encode(f.read()).decode()
-                parts.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded}"}, "document": True})
-        elif mime_type.startswith("application/vnd.openxmlformats") or fname.lower().endswith(".docx"):
-            uid = msg.document.file_unique_id or msg.document.file_id
-            out_path = os.path.join(CACHE_DIR, f"{uid}.txt")
-            if not os.path.exists(out_path):
-                print("ℹ️ Extracting text from DOCX file")
-                doc_bytes = await client.download_media(msg, in_memory=True)
-                doc = Document(BytesIO(doc_bytes.getvalue()))
-                text_content = "\n".join(p.text for p in doc.paragraphs)
-                with open(out_path, "w", encoding="utf-8") as f:
-                    f.write(text_content)
-                print(f"✅ Saved DOCX text to {out_path}")
-            else:
-                print(f"ℹ️ Loading cached DOCX text from {out_path}")
-                with open(out_path, "r", encoding="utf-8") as f:
-                    text_content = f.read()
-            if text_content:
-                parts.append({"type": "text", "text": text_content, "document": True})
-        elif mime_type.startswith("text/") or fname.lower().endswith((".txt", ".md", ".log")):
-            text_bytes = await client.download_media(msg, in_memory=True)
+        if mime_type.startswith("text/") or fname.lower().endswith((".txt", ".md", ".log")):
+            with metrics.span("download"):
+                text_bytes = await client.download_media(msg, in_memory=True)
             try:
                 text_content = text_bytes.getvalue().decode("utf-8")
             except UnicodeDecodeError:
                 text_content = text_bytes.getvalue().decode("latin-1")
             parts.append({"type": "text", "text": text_content})
-    if media:
-        encoded = base64.b64encode(media.getvalue()).decode()
-        parts.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded}"}})
 
     if not parts:
         parts.append({"type": "text", "text": "[non-text message]"})
@@ -169,26 +271,105 @@ def merge_text_parts(messages):
         msg["content"] = new_content
     return messages
 
-async def build_openai_messages(client: Client, history, new_messages, system_prompt: str, ai_client: AIClient):
+def plan_media(entries):
+    """Pick the single entry whose media will be sent, from message metadata only."""
+    survivor = None
+    for entry in entries:
+        msg = entry["message"]
+        if msg is not None and media_kind(msg):
+            survivor = entry
+    return survivor
+
+
+def media_tokens(msg: Message) -> int:
+    """Estimate the tokens of a message's media before downloading it."""
+    kind = media_kind(msg)
+    if kind == "pdf":
+        # Scanned PDFs are sent as up to PDF_MAX_PAGES images.
+        return pdf_settings()["max_pages"] * estimator.image_tokens
+    return estimator.image_tokens if kind else 0
+
+
+async def prepare_entries(client: Client, entries, ai_client: AIClient, survivor=None):
+    """Convert entries with placeholders instead of media.
+
+    The ``survivor`` keeps media it already has loaded; otherwise it gets the
+    ``media_tokens`` estimate, so packing can decide whether its media fits
+    before anything is downloaded.  Its placeholder parts are kept as
+    ``fallback`` for when it does not.
+    """
+    for entry in entries:
+        if entry is not survivor and entry["media_loaded"]:
+            # Placeholders are cheap to rebuild, and dropping a stale payload frees memory.
+            entry["parts"] = None
+            entry["media_loaded"] = False
+        if entry is not survivor:
+            entry.pop("fallback", None)
+            entry.pop("media_tokens", None)
+        if entry["parts"] is None:
+            entry["parts"] = await message_to_content(client, entry["message"], ai_client, include_media=False)
+            entry["media_loaded"] = False
+        if entry is survivor and not entry["media_loaded"]:
+            entry["fallback"] = entry["parts"]
+            entry["media_tokens"] = media_tokens(entry["message"])
+
+
+async def load_media(client: Client, entry, ai_client: AIClient):
+    """Download and convert the media of an entry that packing kept with its media."""
+    fallback = entry["fallback"]
+    entry["parts"] = await message_to_content(client, entry["message"], ai_client, include_media=True)
+    entry["media_loaded"] = True
+    entry["fallback"] = fallback
+    entry.pop("media_tokens", None)
+
+
+async def build_openai_messages(
+    client: Client,
+    history,
+    new_messages,
+    system_prompt: str,
+    ai_client: AIClient,
+    context_note: str | None = None,
+    stable: bool = False,
+):
+    """Build the request from history cache entries and the entries of new messages.
+
+    Entries without prepared parts are converted once and keep their parts,
+    so the history cache does not convert them again on the next reply.
+    Only the last media item can be sent; other media become placeholders.
+    History is packed into the token budget, newest messages first, before
+    that media is downloaded, and the media is only downloaded if it fits.
+    ``context_note`` is appended after the new messages, so volatile context
+    does not change the prompt prefix.
+    """
     messages = [{"role": "system", "content": [{"type": "text", "text": system_prompt}]}]
 
-    for msg in history:
-        prepared = await message_to_content(client, msg, ai_client)
-        if prepared != 0:
-            role = "assistant" if msg.outgoing else "user"
-            if messages[-1]["role"] == role:
-                messages[-1]["content"].extend(prepared)
-            else:
-                messages.append({"role": role, "content": prepared})
-
     if not isinstance(new_messages, list):
         new_messages = [new_messages]
 
-    combined_new = []
-    for msg in new_messages:
-        prepared = await message_to_content(client, msg, ai_client)
+    survivor = plan_media(history + new_messages)
+    await prepare_entries(client, history, ai_client, survivor)
+    await prepare_entries(client, new_messages, ai_client, survivor)
+    kept, combined_new = pack_context(system_prompt, history, new_messages, stable=stable)
+    if survivor is not None and "media_tokens" in survivor:
+        if any(e is survivor for e in kept + new_messages):
+            await load_media(client, survivor, ai_client)
+            # The estimate may be off, e.g. for a text PDF; packing again falls back if it is.
+            kept, combined_new = pack_context(system_prompt, history, new_messages, stable=stable)
+        else:
+            use_fallback(survivor)
+    history = kept
+    if context_note:
+        combined_new.append({"type": "text", "text": context_note})
+
+    for entry in history:
+        prepared = entry["parts"]
         if prepared != 0:
-            combined_new.extend(prepared)
+            role = entry["role"]
+            if messages[-1]["role"] == role:
+                messages[-1]["content"].extend(prepared)
+            else:
+                messages.append({"role": role, "content": list(prepared)})
 
     if combined_new:
         if messages[-1]["role"] == "user":
@@ -201,6 +382,14 @@ async def build_openai_messages(client: Client, history, new_messages, system_pr
     return messages
 
 
+def calibrate_estimator(messages, usage: dict):
+    parts = [p for m in messages for p in m["content"]]
+    if any(p.get("type") == "image_url" for p in parts):
+        return
+    estimated = sum(estimator.parts_tokens(m["content"]) for m in messages)
+    estimator.calibrate(estimated, usage.get("prompt_tokens"))
+
+
 async def send_typing_loop(client: Client, chat_id: int, stop_event: asyncio.Event):
     while not stop_event.is_set():
         try:
@@ -209,13 +398,21 @@ async def send_typing_loop(client: Client, chat_id: int, stop_event: asyncio.Eve
             print(f"⛔ Typing notification error for {chat_id}: {e}")
         await asyncio.sleep(random.uniform(2, 3))
 
+def _sent_message_id(updates):
+    for update in getattr(updates, "updates", []):
+        if isinstance(update, raw.types.UpdateMessageID):
+            return update.id
+    return getattr(updates, "id", None)
+
+
 async def send_message_in_topic(client: Client, chat_id: int, text: str, topic_id: int | None):
+    """Send text to the chat or topic and return the id of the sent message."""
     if not topic_id:
-        await client.send_message(chat_id, text)
-        return
+        sent = await client.send_message(chat_id, text)
+        return sent.id
 
     try:
-        await client.invoke(
+        updates = await client.invoke(
             raw.functions.messages.SendMessage(
                 peer=await client.resolve_peer(chat_id),
                 message=text,
@@ -224,30 +421,122 @@ async def send_message_in_topic(client: Client, chat_id: int, text: str, topic_i
                 top_msg_id=topic_id,
             )
         )
+        return _sent_message_id(updates)
     except Exception as e:
         print(f"⛔ Failed to send message in topic {chat_id}:{topic_id}: {e}")
+    return None
+
+
+async def edit_message(client: Client, chat_id: int, message_id: int, text: str, final: bool = False) -> float:
+    """Edit a sent message, returning seconds until the next edit is allowed."""
+    while True:
+        try:
+            await client.edit_message_text(chat_id, message_id, text)
+            return 0
+        except MessageNotModified:
+            return 0
+        except FloodWait as e:
+            if not final:
+                return e.value
+            print(f"ℹ️ Flood wait {e.value}s before final edit in {chat_id}")
+            await asyncio.sleep(e.value)
+
+
+async def stream_reply(
+    client: Client,
+    chat_id: int,
+    topic_id: int | None,
+    reply_to: Message | None,
+    chunks,
+    typing_stop: asyncio.Event | None = None,
+    job=None,
+):
+    """Send the first chunk as soon as possible, then edit the message in throttled batches.
+
+    Returns the full reply text and the id of the sent message.  If the reply
+    is cancelled before ``job`` is committed, the partial message is deleted.
+    Raises RuntimeError when the first chunk cannot be sent.
+    """
+    interval = float(getenv("STREAM_EDIT_INTERVAL", 2))
+    first_chars = int(getenv("STREAM_FIRST_CHUNK_CHARS", 20))
+    text = ""
+    shown = ""
+    sent_id = None
+    next_edit = 0.0
+    try:
+        async for delta in chunks:
+            text += delta
+            if sent_id is None:
+                if len(text.strip()) < first_chars:
+                    continue
+                shown = text.strip()
+                if reply_to is not None:
+                    sent_id = (await reply_to.reply_text(shown)).id
+                else:
+                    sent_id = await send_message_in_topic(client, chat_id, shown, topic_id)
+                if sent_id is None:
+                    # Failed, or sent without a known id: either way it cannot be edited,
+                    # and sending the reply again could duplicate it.
+                    raise RuntimeError(f"Failed to send the first chunk of the reply to {chat_id}:{topic_id}")
+                if typing_stop is not None:
+                    typing_stop.set()
+                next_edit = time.monotonic() + interval
+            elif time.monotonic() >= next_edit and text.strip() != shown:
+                shown = text.strip()
+                wait = await edit_message(client, chat_id, sent_id, shown)
+                next_edit = time.monotonic() + max(interval, wait)
+    except asyncio.CancelledError:
+        if sent_id is not None:
+            await client.delete_messages(chat_id, sent_id)
+        raise
+    finally:
+        await chunks.aclose()
+    if job is not None:
+        job.commit()
+
+    text = text.strip()
+    if sent_id is None:
+        if not text:
+            return text, None
+        if reply_to is not None:
+            sent_id = (await reply_to.reply_text(text)).id
+        else:
+            sent_id = await send_message_in_topic(client, chat_id, text, topic_id)
+    elif text != shown:
+        await asyncio.sleep(max(next_edit - time.monotonic(), 0))
+        await edit_message(client, chat_id, sent_id, text, final=True)
+    return text, sent_id
+
+
+async def fetch_history(client: Client, chat_id: int, topic_id: int | None, limit: int):
+    history = []
+    if topic_id:
+        async for m in client.get_discussion_replies(chat_id, topic_id, limit=limit):
+            history.append(m)
+    else:
+        async for m in client.get_chat_history(chat_id, limit=limit):
+            history.append(m)
+    history.reverse()
+    return history
 
 
 async def process_waiting_messages(
     client: Client,
     chat_key,
-    waiting_dict,
-    waiting_lock,
+    msgs,
     ai_client,
-    delay: int | None = None,
-    reply_targets: dict | None = None,
+    reply_to: Message | None = None,
+    history_cache: HistoryCache | None = None,
+    job=None,
 ):
+    """Reply to a batch of messages collected by the scheduler for one chat.
+
+    Between ``job.generating()`` and ``job.commit()`` the scheduler may cancel
+    this coroutine to restart it with newer messages merged into the batch.
+    """
     chat_id = chat_key[0] if isinstance(chat_key, tuple) else chat_key
     topic_id = chat_key[1] if isinstance(chat_key, tuple) else None
     print(f"🤖 Processing waiting messages for {chat_id}:{topic_id}")
-    if delay is None:
-        delay = int(os.getenv("NEXT_MESSAGE_WAIT_TIME", 10))
-    await asyncio.sleep(delay)
-    async with waiting_lock:
-        msgs = waiting_dict.pop(chat_key, [])
-        reply_to = None
-        if reply_targets is not None:
-            reply_to = reply_targets.pop(chat_key, None)
     if not msgs:
         return
     if chat_id < 0:
@@ -258,42 +547,93 @@ async def process_waiting_messages(
             or msgs[-1].from_user.username
             or str(chat_id)
         )
-    system_prompt = enhance_system_prompt(get_system_prompt(chat_id, user_name))
+    stable = getenv("PROMPT_LAYOUT", "default").lower() == "stable"
+    if stable:
+        system_prompt = get_system_prompt(chat_id, user_name)
+        context_note = get_volatile_context()
+    else:
+        system_prompt = enhance_system_prompt(get_system_prompt(chat_id, user_name))
+        context_note = None
     print(f"🤖 Processing {len(msgs)} messages from {chat_id}:{topic_id}")
+    if history_cache is None:
+        history_cache = HistoryCache(max_chats=1)
     try:
-        history = []
-        limit = int(os.getenv("HISTORY_LIMIT")) + len(msgs)
-        if topic_id:
-            async for m in client.get_discussion_replies(chat_id, topic_id, limit=limit):
-                history.append(m)
+        entries = history_cache.lookup(chat_key)
+        if entries is None:
+            print(f"ℹ️ Fetching history for {chat_id}:{topic_id}")
+            limit = int(getenv("HISTORY_LIMIT")) + len(msgs)
+            with metrics.span("fetch_history"):
+                history = await fetch_history(client, chat_id, topic_id, limit)
+            history_cache.seed(chat_key, history)
+        for m in msgs:
+            history_cache.add_message(chat_key, m)
+        entries = history_cache.entries(chat_key)
+
+        by_id = {e["id"]: e for e in entries}
+        new_ids = {m.id for m in msgs}
+        new_entries = [by_id.get(m.id) or make_entry(m) for m in msgs]
+        limit = int(getenv("HISTORY_LIMIT")) - 1
+        prev_entries = [e for e in entries if e["id"] not in new_ids]
+        if stable:
+            prev_entries = stable_candidates(prev_entries, limit)
         else:
-            async for m in client.get_chat_history(chat_id, limit=limit):
-                history.append(m)
-
-        for m in reversed(msgs):
-            if history and history[0].id == m.id:
-                history = history[1:]
-        limit = int(os.getenv("HISTORY_LIMIT")) - 1
-        prev_msgs = list(reversed(history[:limit]))
-        openai_messages = await build_openai_messages(client, prev_msgs, msgs, system_prompt, ai_client)
+            prev_entries = prev_entries[max(len(prev_entries) - limit, 0):]
+        with metrics.span("build"):
+            openai_messages = await build_openai_messages(
+                client, prev_entries, new_entries, system_prompt, ai_client,
+                context_note=context_note, stable=stable,
+            )
+        if job is not None:
+            # Restarts for newer messages wait until here, so converted media is never thrown away.
+            job.generating()
         print("🤖 Sending message to AI, with typing notification")
         await client.send_chat_action(chat_id, ChatAction.TYPING)
         stop_event = asyncio.Event()
         typing_task = asyncio.create_task(send_typing_loop(client, chat_id, stop_event))
-        reply = await asyncio.to_thread(ai_client.complete, openai_messages)
-        stop_event.set()
-        await typing_task
-        print(f"🤖 Reply to {msgs[-1].from_user.first_name}: {reply}")
-
-        if reply_to is not None:
-            await reply_to.reply_text(reply)
-        else:
-            await send_message_in_topic(client, chat_id, reply, topic_id)
+        try:
+            usage = {}
+            if getenv("AI_STREAM", "false").lower() in ["1", "true", "yes"]:
+                chunks = await ai_client.acomplete(openai_messages, stream=True, usage=usage)
+                # Generation and sending overlap when streaming, so they share one span.
+                with metrics.span("llm_stream"):
+                    reply, sent_id = await stream_reply(
+                        client, chat_id, topic_id, reply_to, chunks, typing_stop=stop_event, job=job
+                    )
+                calibrate_estimator(openai_messages, usage)
+                print(f"🤖 Reply to {msgs[-1].from_user.first_name}: {reply}")
+            else:
+                with metrics.span("llm"):
+                    reply = await ai_client.acomplete(openai_messages, usage=usage)
+                calibrate_estimator(openai_messages, usage)
+                if job is not None:
+                    job.commit()
+                stop_event.set()
+                print(f"🤖 Reply to {msgs[-1].from_user.first_name}: {reply}")
+
+                with metrics.span("send"):
+                    if reply_to is not None:
+                        sent = await reply_to.reply_text(reply)
+                        sent_id = sent.id
+                    else:
+                        sent_id = await send_message_in_topic(client, chat_id, reply, topic_id)
+        finally:
+            stop_event.set()
+            typing_task.cancel()
+        if "first_token_seconds" in usage:
+            print(f"⏱️ First token after {usage['first_token_seconds']:.2f}s")
+        if reply:
+            history_cache.add_reply(chat_key, sent_id, reply)
+        metrics.count("replies")
+        metrics.count("prompt_tokens", usage.get("prompt_tokens", 0))
+        metrics.count("completion_tokens", usage.get("completion_tokens", 0))
     except ValueError as e:
+        metrics.count("reply_errors")
         print(f"⛔ Error for chat {chat_id}: {e}")
     except KeyError as e:
+        metrics.count("reply_errors")
         print(f"⛔ Error for chat {chat_id}: {e}")
     except Exception as e:
+        metrics.count("reply_errors")
         print(f"⛔ Unexpected error for chat {chat_id}: {e}")
     finally:
         await client.send_chat_action(chat_id, ChatAction.CANCEL)
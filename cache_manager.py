@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import asyncio
+from config import getenv
+
+INDEX_FILE = "index.json"
+
+
+class CacheManager:
+    """Byte quota with LRU eviction for the files under data/<instance>/cache.
+
+    A compact index of relative path -> [size, last access] replaces directory
+    listings on lookup.  The index is rebuilt from disk by ``compact`` at
+    startup and written back at most every ``save_interval`` seconds, in a
+    worker thread when called from the event loop; ``flush`` writes it on
+    shutdown.
+    """
+
+    def __init__(self, root: str, quota_bytes: int | None = None, save_interval: float = 60):
+        if quota_bytes is None:
+            quota_bytes = int(float(getenv("CACHE_QUOTA_MB", 1024)) * 1024 * 1024)
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.save_interval = save_interval
+        self._index: dict[str, list] = {}
+        self._bytes = 0
+        self._dirty = False
+        self._saved_at = 0.0
+        self._saving = None
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    def _index_path(self) -> str:
+        return os.path.join(self.root, INDEX_FILE)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), "r", encoding="utf-8") as f:
+                self._index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._index = {}
+        self._bytes = sum(size for size, _ in self._index.values())
+
+    def _write(self, index: dict):
+        path = self._index_path()
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp, path)
+
+    def save(self, force: bool = False):
+        if not self._dirty and not force:
+            return
+        self._write(self._index)
+        self._dirty = False
+        self._saved_at = time.time()
+
+    async def _save_in_thread(self, index: dict):
+        try:
+            await asyncio.to_thread(self._write, index)
+        except Exception as e:
+            self._dirty = True
+            print(f"⛔ Saving cache index failed: {e}")
+
+    def _maybe_save(self):
+        if not self._dirty or time.time() - self._saved_at <= self.save_interval:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        if self._saving is not None and not self._saving.done():
+            return
+        self._dirty = False
+        self._saved_at = time.time()
+        # A shallow copy, so the loop may keep changing the index while it is written.
+        self._saving = loop.create_task(self._save_in_thread(dict(self._index)))
+
+    async def flush(self):
+        """Write pending index changes, for shutdown."""
+        if self._saving is not None:
+            await self._saving
+            self._saving = None
+        await asyncio.to_thread(self.save)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def contains(self, name: str) -> bool:
+        return name in self._index
+
+    def touch(self, name: str):
+        entry = self._index.get(name)
+        if entry is not None:
+            entry[1] = time.time()
+            self._dirty = True
+            self._maybe_save()
+
+    def add(self, name: str, size: int | None = None):
+        """Record a file written under the cache root and evict down to the quota."""
+        if size is None:
+            size = os.path.getsize(self.path(name))
+        old = self._index.get(name)
+        if old is not None:
+            self._bytes -= old[0]
+        self._index[name] = [size, time.time()]
+        self._bytes += size
+        self._dirty = True
+        self.evict()
+        self._maybe_save()
+
+    def remove(self, name: str):
+        entry = self._index.pop(name, None)
+        if entry is not None:
+            self._bytes -= entry[0]
+            self._dirty = True
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        if self._bytes <= self.quota_bytes:
+            return
+        for name, _ in sorted(self._index.items(), key=lambda item: item[1][1]):
+            if self._bytes <= self.quota_bytes:
+                break
+            self.remove(name)
+            self.evictions += 1
+
+    def compact(self):
+        """Rebuild the index from disk, drop leftovers and enforce the quota."""
+        found = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                full = os.path.join(dirpath, filename)
+                name = os.path.relpath(full, self.root)
+                if name in (INDEX_FILE, f"{INDEX_FILE}.tmp"):
+                    continue
+                if filename.endswith(".tmp"):
+                    os.remove(full)
+                    continue
+                st = os.stat(full)
+                known = self._index.get(name)
+                found[name] = [st.st_size, known[1] if known else st.st_mtime]
+        self._index = found
+        self._bytes = sum(size for size, _ in found.values())
+        self._dirty = True
+        self.evict()
+        for dirpath, dirnames, filenames in os.walk(self.root, topdown=False):
+            if dirpath != self.root and not dirnames and not filenames:
+                os.rmdir(dirpath)
+        self.save()
+
+    def usage(self) -> dict:
+        return {
+            "files": len(self._index),
+            "bytes": self._bytes,
+            "quota_bytes": self.quota_bytes,
+            "evictions": self.evictions,
+        }
+
+
+def format_usage(usage: dict) -> str:
+    mb = 1024 * 1024
+    return (
+        f"{usage['bytes'] / mb:.1f} MB of {usage['quota_bytes'] / mb:.0f} MB "
+        f"in {usage['files']} files, {usage['evictions']} evicted"
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python cache_manager.py <instance>")
+        sys.exit(1)
+    from dotenv import load_dotenv
+
+    load_dotenv(f".env.{sys.argv[1]}")
+    manager = CacheManager(os.path.join("data", sys.argv[1], "cache"))
+    manager.compact()
+    print(f"ℹ️ Cache usage: {format_usage(manager.usage())}")
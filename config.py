@@ -0,0 +1,39 @@
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dotenv import dotenv_values
+
+# Settings of the instance the current task belongs to, layered over os.environ.
+_instance_env: ContextVar[dict | None] = ContextVar("instance_env", default=None)
+
+
+def getenv(key: str, default=None):
+    """``os.getenv`` that sees the settings of the current instance in host mode.
+
+    A single-instance process loads its ``.env.<instance>`` into os.environ and
+    never sets an overlay, so this is plain ``os.getenv`` there.
+    """
+    env = _instance_env.get()
+    if env is not None and key in env:
+        return env[key]
+    return os.getenv(key, default)
+
+
+def load_instance_env(instance: str) -> dict:
+    env = {k: v for k, v in dotenv_values(f".env.{instance}").items() if v is not None}
+    env["INSTANCE_NAME"] = instance
+    return env
+
+
+def activate(env: dict | None):
+    """Use ``env`` for the rest of the current task and the tasks it creates."""
+    _instance_env.set(env)
+
+
+@contextmanager
+def instance_env(env: dict | None):
+    token = _instance_env.set(env)
+    try:
+        yield
+    finally:
+        _instance_env.reset(token)
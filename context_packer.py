@@ -0,0 +1,196 @@
+from config import getenv
+
+try:
+    import tiktoken  # type: ignore
+except Exception:
+    tiktoken = None
+
+MESSAGE_OVERHEAD = 4
+
+
+class TokenEstimator:
+    """Cheap token estimate for content parts.
+
+    Text is measured in UTF-8 bytes per token, which is close for Latin text
+    and errs on the safe side for Cyrillic.  The ratio is recalibrated from the
+    prompt token counts reported by the backend.  If ``TOKENIZER=tiktoken`` and
+    tiktoken is installed, text is counted with it instead.
+    """
+
+    def __init__(self):
+        self.bytes_per_token = float(getenv("TOKEN_BYTES_RATIO", 4.0))
+        self.image_tokens = int(getenv("IMAGE_TOKEN_COST", 512))
+        self._encoding = None
+        if getenv("TOKENIZER", "").lower() == "tiktoken" and tiktoken is not None:
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+
+    def text_tokens(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return int(len(text.encode("utf-8")) / self.bytes_per_token) + 1
+
+    def part_tokens(self, part: dict) -> int:
+        if part.get("type") == "image_url":
+            return self.image_tokens
+        return self.text_tokens(part.get("text", ""))
+
+    def parts_tokens(self, parts) -> int:
+        if not parts:
+            return 0
+        return MESSAGE_OVERHEAD + sum(self.part_tokens(p) for p in parts)
+
+    def calibrate(self, estimated: int, actual: int | None):
+        """Move the bytes-per-token ratio towards what the backend actually counted."""
+        if self._encoding is not None or not actual or estimated <= 0:
+            return
+        observed = self.bytes_per_token * estimated / actual
+        self.bytes_per_token = min(max(0.8 * self.bytes_per_token + 0.2 * observed, 1.0), 8.0)
+
+
+estimator = TokenEstimator()
+
+
+def default_budget() -> int:
+    """8192 tokens of text plus room for a PDF rendered to ``PDF_MAX_PAGES`` images."""
+    return 8192 + int(getenv("PDF_MAX_PAGES", 20)) * estimator.image_tokens
+
+
+def context_budget(system_prompt: str, max_tokens: int | None = None) -> int:
+    """Tokens left for history and new messages after the system prompt and the reply."""
+    total = int(getenv("CONTEXT_TOKEN_BUDGET", 0)) or default_budget()
+    if max_tokens is None:
+        max_tokens = int(getenv("AI_MAX_TOKENS", 512))
+    return total - max_tokens - estimator.text_tokens(system_prompt) - MESSAGE_OVERHEAD
+
+
+def truncate_parts(parts, budget: int):
+    """Return a copy of parts whose longest text parts are cut to fit budget tokens."""
+    parts = [dict(p) for p in parts]
+    excess = estimator.parts_tokens(parts) - budget
+    for part in sorted(parts, key=lambda p: -len(p.get("text", ""))):
+        if excess <= 0:
+            break
+        if part.get("type") != "text":
+            continue
+        text = part["text"]
+        tokens = estimator.text_tokens(text)
+        keep = max(tokens - excess, 0)
+        part["text"] = text[: int(len(text) * keep / tokens)] + "\n[truncated]"
+        excess -= tokens - keep
+    return parts
+
+
+def _entry_tokens(entry) -> int:
+    """Tokens of the entry's parts plus the estimate of media planned but not loaded yet."""
+    if entry["parts"] == 0:
+        return 0
+    return estimator.parts_tokens(entry["parts"]) + entry.get("media_tokens", 0)
+
+
+def use_fallback(entry) -> bool:
+    """Replace the media of ``entry`` by its placeholder parts, if it has any."""
+    fallback = entry.pop("fallback", None)
+    if fallback is None:
+        return False
+    entry["parts"] = fallback
+    entry["media_loaded"] = False
+    entry.pop("media_tokens", None)
+    return True
+
+
+def _fill_newest(history, budget: int, max_count: int):
+    kept = []
+    used = 0
+    for entry in reversed(history):
+        if len(kept) >= max_count:
+            break
+        tokens = _entry_tokens(entry)
+        # Media that does not fit is sent as its placeholder, so older messages still get in.
+        if used + tokens > budget and use_fallback(entry):
+            print("ℹ️ Media does not fit the context, sending a placeholder")
+            tokens = _entry_tokens(entry)
+        if used + tokens > budget:
+            break
+        used += tokens
+        kept.append(entry)
+    kept.reverse()
+    return kept
+
+
+def _set_anchor(history, entry):
+    for e in history:
+        e.pop("anchor", None)
+    if entry is not None:
+        entry["anchor"] = True
+
+
+def stable_candidates(history, max_count: int):
+    """Return the entries that may be kept by ``pack_stable``, so only those get converted.
+
+    The history window stays anchored at the same first message between turns
+    and only grows at its end, which keeps the prompt prefix byte-identical and
+    the backend's prefix cache hitting.  Once the window exceeds ``max_count``,
+    it is re-anchored to the newest half, so the prefix shifts rarely and in
+    one large step.  The anchor is stored on the cached history entry.
+    """
+    start = next((i for i, e in enumerate(history) if e.get("anchor")), None)
+    if start is None:
+        return history[max(len(history) - max_count, 0):]
+    if len(history) - start <= max_count:
+        return history[start:]
+    kept = history[len(history) - max_count // 2:] if max_count // 2 else []
+    _set_anchor(history, kept[0] if kept else None)
+    print(f"ℹ️ Re-anchored history window to {len(kept)} messages")
+    return kept
+
+
+def pack_stable(history, budget: int):
+    """Token-budget counterpart of ``stable_candidates``, re-anchoring to half the budget."""
+    if history and history[0].get("anchor"):
+        if sum(_entry_tokens(e) for e in history) <= budget:
+            return history
+        kept = _fill_newest(history, budget // 2, len(history))
+        print(f"ℹ️ Re-anchored history window to {len(kept)} messages")
+    else:
+        kept = _fill_newest(history, budget, len(history))
+    _set_anchor(history, kept[0] if kept else None)
+    return kept
+
+
+def _new_tokens(new_entries) -> int:
+    parts = [p for e in new_entries if e["parts"] != 0 for p in e["parts"]]
+    return estimator.parts_tokens(parts) + sum(e.get("media_tokens", 0) for e in new_entries)
+
+
+def pack_context(system_prompt: str, history, new_entries, stable: bool = False):
+    """Fit entries into the token budget, newest first.
+
+    New messages are always kept, truncated if they alone exceed the budget.
+    History entries are added from the newest until the next one does not fit.
+    Entries carrying media that does not fit fall back to their placeholder
+    parts instead.  Media planned but not loaded yet is counted with its
+    ``media_tokens`` estimate.  With ``stable`` set, history is packed with
+    the anchored ``pack_stable``.  Returns the kept history entries and the
+    parts of the new entries.
+    """
+    budget = context_budget(system_prompt)
+    used = _new_tokens(new_entries)
+    if used > budget and any([use_fallback(e) for e in new_entries]):
+        print("ℹ️ Media of the new messages does not fit the context, sending a placeholder")
+        used = _new_tokens(new_entries)
+    new_parts = []
+    for entry in new_entries:
+        if entry["parts"] != 0:
+            new_parts.extend(entry["parts"])
+    if used > budget:
+        print(f"ℹ️ New messages need ~{used} tokens, truncating to {budget}")
+        new_parts = truncate_parts(new_parts, budget)
+        return [], new_parts
+
+    if stable:
+        return pack_stable(history, budget - used), new_parts
+
+    kept = _fill_newest(history, budget - used, len(history))
+    if len(kept) < len(history):
+        print(f"ℹ️ Packed {len(kept)} of {len(history)} history messages")
+    return kept, new_parts
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+from config import getenv
+
+
+def make_entry(msg, parts=None) -> dict:
+    return {
+        "id": msg.id,
+        "role": "assistant" if msg.outgoing else "user",
+        "message": msg,
+        "parts": parts,
+        "media_loaded": False,
+    }
+
+
+class HistoryCache:
+    """Rolling window of already prepared messages per chat_key.
+
+    Entries are filled from incoming handlers and from our own replies, so a
+    reply only has to convert messages that were not seen before.  Chats are
+    evicted in LRU order once ``max_chats`` is exceeded and are fetched from
+    the Telegram API again on the next reply.
+    """
+
+    def __init__(self, max_chats: int | None = None, window: int | None = None):
+        if max_chats is None:
+            max_chats = int(getenv("HISTORY_CACHE_CHATS", 500))
+        if window is None:
+            window = int(getenv("HISTORY_CACHE_WINDOW", 2 * int(getenv("HISTORY_LIMIT", 21))))
+        self.max_chats = max_chats
+        self.window = window
+        self._chats = OrderedDict()
+        self._reply_seq = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _touch(self, chat_key):
+        self._chats.move_to_end(chat_key)
+
+    def _trim(self, chat_key):
+        entries = self._chats[chat_key]
+        while len(entries) > self.window:
+            entries.popitem(last=False)
+
+    def _evict(self):
+        while len(self._chats) > self.max_chats:
+            key, _ = self._chats.popitem(last=False)
+            self.evictions += 1
+            print(f"ℹ️ Evicted history cache for {key}")
+
+    def seed(self, chat_key, messages):
+        """Fill a cold chat from messages fetched through the API (oldest first)."""
+        entries = OrderedDict()
+        for msg in messages:
+            entries[msg.id] = make_entry(msg)
+        self._chats[chat_key] = entries
+        self._touch(chat_key)
+        self._trim(chat_key)
+        self._evict()
+
+    def add_message(self, chat_key, msg):
+        """Append a message to a warm chat. Cold chats are left to the next API fetch."""
+        entries = self._chats.get(chat_key)
+        if entries is None or msg.id in entries:
+            return
+        entries[msg.id] = make_entry(msg)
+        self._touch(chat_key)
+        self._trim(chat_key)
+
+    def replace_message(self, chat_key, msg):
+        """Drop the prepared parts of an edited message so it is converted again."""
+        entries = self._chats.get(chat_key)
+        if entries is None or msg.id not in entries:
+            return
+        entries[msg.id] = make_entry(msg)
+
+    def add_reply(self, chat_key, message_id, text: str):
+        """Store our own sent reply as already prepared assistant content."""
+        entries = self._chats.get(chat_key)
+        if entries is None:
+            return
+        if message_id is None:
+            self._reply_seq += 1
+            message_id = f"reply:{self._reply_seq}"
+        if message_id in entries:
+            return
+        entries[message_id] = {
+            "id": message_id,
+            "role": "assistant",
+            "message": None,
+            "parts": [{"type": "text", "text": text}],
+            "media_loaded": False,
+        }
+        self._touch(chat_key)
+        self._trim(chat_key)
+
+    def lookup(self, chat_key) -> list | None:
+        """Return cached entries (oldest first) or None when the chat is cold."""
+        if chat_key not in self._chats:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.entries(chat_key)
+
+    def entries(self, chat_key) -> list:
+        entries = self._chats.get(chat_key)
+        if entries is None:
+            return []
+        self._touch(chat_key)
+        return list(entries.values())
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self._chats),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
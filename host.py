@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import asyncio
+from dotenv import load_dotenv
+
+startup_started = time.perf_counter()
+
+from log_utils import setup_logging, install_print
+
+
+def run(instances: list[str]):
+    # Settings shared by all instances (pools, caches, Whisper workers, logging) may live in .env.
+    load_dotenv()
+
+    setup_logging(*instances)
+    install_print()
+
+    imports_started = time.perf_counter()
+    from pyrogram import idle
+    from ai_client import get_http_client
+    from bot import Bot
+    from bot_utils import init_caches, close_caches
+    from metrics import serve_metrics
+    from config import load_instance_env
+
+    imports_seconds = time.perf_counter() - imports_started
+
+    init_caches(os.getenv("HOST_DATA_DIR", os.path.join("data", "host")))
+    get_http_client()
+
+    bots = []
+    transcription = None
+    for name in instances:
+        print(f"ℹ️ Loading instance: {name}")
+        bot = Bot(name, env=load_instance_env(name), transcription=transcription)
+        # Every instance transcribes with the Whisper model of the first one.
+        transcription = bot.ai_client.transcription
+        bots.append(bot)
+
+    async def main():
+        init_seconds = time.perf_counter() - startup_started
+        connect_started = time.perf_counter()
+        # gather runs each start in its own task, so instance settings do not leak.
+        results = await asyncio.gather(*(bot.start() for bot in bots), return_exceptions=True)
+        started = []
+        for bot, result in zip(bots, results):
+            if isinstance(result, BaseException):
+                print(f"⛔ Instance {bot.name} failed to start: {result}")
+            else:
+                started.append(bot)
+        if not started:
+            raise RuntimeError("No instance started")
+        print(
+            f"✅ Started {len(started)} of {len(bots)} instances in {time.perf_counter() - startup_started:.2f}s "
+            f"(imports {imports_seconds:.2f}s, init {init_seconds - imports_seconds:.2f}s, "
+            f"connect and checks {time.perf_counter() - connect_started:.2f}s)"
+        )
+        metrics_port = os.getenv("METRICS_PORT")
+        metrics_server = await serve_metrics(int(metrics_port)) if metrics_port else None
+        try:
+            await idle()
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
+            await asyncio.gather(*(bot.stop() for bot in started))
+            await close_caches()
+
+    bots[0].client.run(main())
+
+
+# Guarded so the spawned PDF and Whisper worker processes can import this module.
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python host.py <instance> [<instance> ...]")
+        sys.exit(1)
+    run(sys.argv[1:])
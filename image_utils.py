@@ -0,0 +1,59 @@
+from io import BytesIO
+from config import getenv
+
+try:
+    from PIL import Image, ImageOps  # type: ignore
+except Exception:
+    Image = None
+
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "png": ("PNG", "image/png", "png"),
+}
+
+
+def image_settings() -> dict:
+    fmt = getenv("IMAGE_FORMAT", "jpeg").lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown IMAGE_FORMAT '{fmt}'")
+    return {
+        "max_edge": int(getenv("IMAGE_MAX_EDGE", 1568)),
+        "format": fmt,
+        "quality": int(getenv("IMAGE_QUALITY", 85)),
+    }
+
+
+def normalize_image(data: bytes, mime_type: str, settings: dict | None = None) -> tuple[bytes, str]:
+    """Downsize to the max edge and recompress to the target format.
+
+    The original is returned when Pillow is missing, cannot read the image,
+    or when it already is a small image of the target format that re-encoding
+    would not shrink.
+    """
+    if Image is None:
+        return data, mime_type
+    settings = settings or image_settings()
+    pil_format, target_mime, _ = FORMATS[settings["format"]]
+    try:
+        with Image.open(BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)
+            resized = max(img.size) > settings["max_edge"]
+            if resized:
+                img.thumbnail((settings["max_edge"], settings["max_edge"]), Image.LANCZOS)
+            if pil_format == "JPEG" and img.mode != "RGB":
+                background = Image.new("RGB", img.size, "white")
+                rgba = img.convert("RGBA")
+                background.paste(rgba, mask=rgba.getchannel("A"))
+                img = background
+            out = BytesIO()
+            img.save(out, pil_format, quality=settings["quality"], optimize=True)
+    except Exception as e:
+        print(f"⛔ Image normalization failed: {e}")
+        return data, mime_type
+    result = out.getvalue()
+    if not resized and mime_type == target_mime and len(result) >= len(data):
+        return data, mime_type
+    return result, target_mime
@@ -0,0 +1,149 @@
+import os
+import sys
+import queue
+import atexit
+import logging
+import builtins
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from config import getenv
+
+_record_factory = logging.getLogRecordFactory()
+
+
+def _instance_record(*args, **kwargs):
+    # Stamped when the record is created, in the task of the instance that logged it.
+    record = _record_factory(*args, **kwargs)
+    record.instance = getenv("INSTANCE_NAME") or ""
+    return record
+
+
+class TruncatingFormatter(logging.Formatter):
+    """Cuts messages longer than ``max_chars``, such as whole replies or documents."""
+
+    def __init__(self, fmt: str, max_chars: int):
+        super().__init__(fmt, datefmt="%H:%M")
+        self.max_chars = max_chars
+
+    def formatMessage(self, record) -> str:
+        if self.max_chars and len(record.message) > self.max_chars:
+            cut = len(record.message) - self.max_chars
+            record.message = f"{record.message[:self.max_chars]}… [{cut} more chars]"
+        return super().formatMessage(record)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the listener thread unformatted and drops them when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens in the listener thread; records never leave the process.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_queue_handler = None
+
+
+def log_stats() -> dict:
+    if _queue_handler is None:
+        return {}
+    return {"queued": _queue_handler.queue.qsize(), "dropped": _queue_handler.dropped}
+
+
+class NameFilter(logging.Filter):
+    def filter(self, record) -> bool:
+        return record.name == self.name
+
+
+class InstanceFilter(logging.Filter):
+    def __init__(self, instance: str):
+        super().__init__()
+        self.instance = instance
+
+    def filter(self, record) -> bool:
+        return getattr(record, "instance", "") == self.instance
+
+
+def setup_logging(*names: str):
+    """Log to the console and to logs/<name>.log through a background thread.
+
+    Callers only put records on a bounded queue; formatting, truncation to
+    ``LOG_MAX_RECORD_CHARS`` and all writes happen in a QueueListener thread,
+    so a slow disk or console never stalls the event loop.  Records are dropped
+    and counted when the queue is full.  Log files rotate at ``LOG_MAX_MB``.
+
+    With several names (host mode) each instance file receives only the records
+    of its instance, records of shared services go to logs/host.log and console
+    lines are prefixed with the instance name.
+    """
+    global _queue_handler
+    root_logger = logging.getLogger()
+    if root_logger.handlers:
+        return
+
+    root_logger.setLevel(logging.INFO)
+    logging.setLogRecordFactory(_instance_record)
+
+    max_chars = int(getenv("LOG_MAX_RECORD_CHARS", 2000))
+    host = len(names) > 1
+    fmt = TruncatingFormatter("%(asctime)s %(message)s", max_chars)
+    console_fmt = TruncatingFormatter("%(asctime)s [%(instance)s] %(message)s", max_chars) if host else fmt
+    handlers = []
+    # ui.py turns the console off: it shows the log files and keeps stderr only for crashes.
+    console = getenv("LOG_CONSOLE", "true").lower() in ["1", "true", "yes"]
+
+    if console:
+        error_handler = logging.StreamHandler(sys.stderr)
+        error_handler.setLevel(logging.ERROR)
+        error_handler.setFormatter(console_fmt)
+        handlers.append(error_handler)
+
+    os.makedirs("logs", exist_ok=True)
+    max_bytes = int(float(getenv("LOG_MAX_MB", 10)) * 1024 * 1024)
+    backups = int(getenv("LOG_BACKUPS", 5))
+    for name in [*names, "host"] if host else names:
+        if not name:
+            continue
+        file_handler = RotatingFileHandler(
+            os.path.join("logs", f"{name}.log"), maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+        )
+        file_handler.setFormatter(fmt)
+        file_handler.setLevel(logging.INFO)
+        if host:
+            file_handler.addFilter(InstanceFilter("" if name == "host" else name))
+        handlers.append(file_handler)
+
+    if console:
+        # Only print() output goes to stdout, other INFO records only to the log files.
+        info_handler = logging.StreamHandler(sys.stdout)
+        info_handler.setFormatter(console_fmt)
+        info_handler.addFilter(NameFilter("print"))
+        handlers.append(info_handler)
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(int(getenv("LOG_QUEUE_SIZE", 10000))))
+    root_logger.addHandler(_queue_handler)
+    listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logging.getLogger("print").setLevel(logging.INFO)
+
+
+def log_print(*args, sep=" ", end="\n", **kwargs):
+    logging.getLogger("print").info(sep.join(str(a) for a in args))
+
+
+def install_print():
+    """Route print() of every module through the "print" logger."""
+    # Ensure console can display Unicode
+    if hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(encoding="utf-8", errors="replace")
+        sys.stderr.reconfigure(encoding="utf-8", errors="replace")
+    builtins.print = log_print
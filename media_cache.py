@@ -0,0 +1,111 @@
+import os
+import json
+import asyncio
+import hashlib
+from collections import OrderedDict
+from config import getenv
+
+
+def payload_key(uid: str, params: dict) -> str:
+    """Cache key of a media payload: file_unique_id plus a digest of its render parameters."""
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+    return f"{uid}_{digest}"
+
+
+def _parts_size(parts) -> int:
+    size = 0
+    for part in parts:
+        if part.get("type") == "image_url":
+            size += len(part["image_url"]["url"])
+        else:
+            size += len(part.get("text", ""))
+    return size
+
+
+class MediaPayloadCache:
+    """Ready-to-send content parts of media, on disk with a small in-memory LRU tier.
+
+    Parts are stored already base64-encoded, so a repeated reply that includes
+    a PDF, DOCX or image does not read, render or encode it again.  Disk reads
+    and writes run in worker threads.  The disk tier lives in ``subdir`` of a
+    CacheManager, which owns its index and quota.
+    """
+
+    def __init__(self, manager, subdir: str = "payloads", max_bytes: int | None = None):
+        if max_bytes is None:
+            max_bytes = int(float(getenv("MEDIA_CACHE_MEMORY_MB", 64)) * 1024 * 1024)
+        self.manager = manager
+        self.subdir = subdir
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        os.makedirs(manager.path(subdir), exist_ok=True)
+
+    def name(self, key: str) -> str:
+        return os.path.join(self.subdir, f"{key}.json")
+
+    def _remember(self, key: str, parts):
+        size = _parts_size(parts)
+        if size > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old[1]
+        self._memory[key] = (parts, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted
+
+    @staticmethod
+    def _read(path: str):
+        with open(path, "rb") as f:
+            return json.loads(f.read())
+
+    @staticmethod
+    def _write(path: str, parts) -> int:
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(parts, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        return os.path.getsize(path)
+
+    async def aget(self, key: str):
+        """Return cached parts or None, reading the disk tier in a worker thread."""
+        cached = self._memory.get(key)
+        if cached is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return cached[0]
+        name = self.name(key)
+        if not self.manager.contains(name):
+            self.misses += 1
+            return None
+        try:
+            parts = await asyncio.to_thread(self._read, self.manager.path(name))
+        except (FileNotFoundError, ValueError):
+            self.manager.remove(name)
+            self.misses += 1
+            return None
+        self.manager.touch(name)
+        self.disk_hits += 1
+        self._remember(key, parts)
+        return parts
+
+    async def aput(self, key: str, parts):
+        self._remember(key, parts)
+        name = self.name(key)
+        size = await asyncio.to_thread(self._write, self.manager.path(name), parts)
+        self.manager.add(name, size)
+
+    def stats(self) -> dict:
+        return {
+            "memory_items": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
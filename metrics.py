@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from config import getenv
+
+SPAN_SAMPLES = 512
+
+
+def _percentile(ordered, q: float) -> float:
+    k = (len(ordered) - 1) * q
+    f = int(k)
+    c = min(f + 1, len(ordered) - 1)
+    return ordered[f] + (ordered[c] - ordered[f]) * (k - f)
+
+
+class _Span:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=SPAN_SAMPLES)
+
+    def add(self, seconds: float, error: bool):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def summary(self) -> dict:
+        ordered = sorted(self.recent)
+        result = {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000,
+        }
+        if ordered:
+            for name, q in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+                result[name] = _percentile(ordered, q) * 1000
+        return result
+
+
+class Metrics:
+    """Timing spans, counters and gauges, kept per instance.
+
+    Spans and counters are filed under the instance of the task that records
+    them, so instances sharing a host process report separately.  Gauges are
+    callables returning a dict, evaluated only when a snapshot is taken.
+    """
+
+    def __init__(self):
+        self._spans: dict[tuple, _Span] = {}
+        self._counters: dict[tuple, int] = {}
+        self._gauges: dict = {}
+        self.started = time.time()
+
+    @staticmethod
+    def _instance() -> str:
+        return getenv("INSTANCE_NAME") or ""
+
+    @contextmanager
+    def span(self, name: str):
+        """Time the block under ``name``; usable around awaits as well."""
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            key = (self._instance(), name)
+            span = self._spans.get(key)
+            if span is None:
+                span = self._spans[key] = _Span()
+            span.add(time.perf_counter() - start, error)
+
+    def count(self, name: str, value: int = 1):
+        key = (self._instance(), name)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, func, shared: bool = False):
+        """Register ``func`` for snapshots of this instance, or of every instance when ``shared``."""
+        self._gauges[("" if shared else self._instance(), name)] = func
+
+    def snapshot(self, instance: str | None = None) -> dict:
+        if instance is None:
+            instance = self._instance()
+        gauges = {}
+        for (owner, name), func in self._gauges.items():
+            if owner in ("", instance):
+                try:
+                    gauges[name] = func()
+                except Exception as e:
+                    gauges[name] = {"error": str(e)}
+        return {
+            "instance": instance,
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "spans": {name: s.summary() for (owner, name), s in self._spans.items() if owner == instance},
+            "counters": {name: v for (owner, name), v in self._counters.items() if owner == instance},
+            "gauges": gauges,
+        }
+
+
+metrics = Metrics()
+
+
+def write_snapshot(path: str, snapshot: dict):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+async def export_snapshots(path: str, interval: float | None = None):
+    """Write this instance's snapshot to ``path`` every ``METRICS_INTERVAL`` seconds, 0 disables it."""
+    if interval is None:
+        interval = float(getenv("METRICS_INTERVAL", 10))
+    if interval <= 0:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    while True:
+        try:
+            await asyncio.to_thread(write_snapshot, path, metrics.snapshot())
+        except Exception as e:
+            print(f"⛔ Metrics snapshot failed: {e}")
+        await asyncio.sleep(interval)
+
+
+async def serve_metrics(port: int, host: str = "127.0.0.1"):
+    """Serve snapshots as JSON on GET /metrics (this instance) or /metrics/<instance>."""
+
+    async def handle(reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            path = request_line[1] if len(request_line) > 1 else "/"
+            if path == "/metrics" or path.startswith("/metrics/"):
+                instance = path[len("/metrics/"):] or None
+                body = json.dumps(metrics.snapshot(instance)).encode()
+                status = "200 OK"
+            else:
+                body = b'{"error": "not found"}'
+                status = "404 Not Found"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"ℹ️ Metrics served on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,181 @@
+import gc
+import sys
+import time
+import asyncio
+import logging
+import threading
+from config import getenv
+
+
+def resident_memory() -> int:
+    """Resident set size of this process in bytes, 0 when unknown."""
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return 0
+
+
+def _format_memory() -> str:
+    return f"{resident_memory() / (1024 * 1024):.0f} MB resident"
+
+
+class LLMUsage:
+    """Last use of one model on one backend, shared by every client of the process."""
+
+    def __init__(self):
+        self.used = 0.0
+        self.loaded = False
+
+
+_llm_usage: dict[tuple, LLMUsage] = {}
+
+
+def llm_usage(base_url: str, model: str) -> LLMUsage:
+    key = (base_url, model)
+    if key not in _llm_usage:
+        _llm_usage[key] = LLMUsage()
+    return _llm_usage[key]
+
+
+class ModelManager:
+    """Loads Whisper on first use and unloads idle models in the background.
+
+    ``WHISPER_WARMUP`` loads Whisper at startup instead.  After
+    ``MODEL_UNLOAD_TIMEOUT`` seconds without use the Whisper model (or the
+    transcription worker processes) is dropped and, for Ollama, the chat model
+    is unloaded with a ``keep_alive: 0`` request.  A timeout of 0 disables
+    unloading.  LLM idle time is tracked per backend and model, so in host
+    mode the model is only unloaded once no instance has used it.
+    """
+
+    def __init__(self, ai_client, unload_timeout: int | None = None, warmup: bool | None = None):
+        if unload_timeout is None:
+            unload_timeout = int(getenv("MODEL_UNLOAD_TIMEOUT", "1800"))
+        if warmup is None:
+            warmup = getenv("WHISPER_WARMUP", "false").lower() in ["1", "true", "yes"]
+        self.ai_client = ai_client
+        self.unload_timeout = unload_timeout
+        self.warmup = warmup
+        self.device = getenv("WHISPER_DEVICE")
+        self.whisper_model = None
+        self.whisper_used = 0.0
+        self.llm = llm_usage(str(ai_client.async_client.base_url), ai_client.model)
+        self.loads = 0
+        self.unloads = 0
+        self.ollama_unloads = 0
+        self._lock = threading.Lock()
+        self._task = None
+
+    def get_whisper(self):
+        """Return the Whisper model, loading it on first use.  Safe to call from worker threads."""
+        self.whisper_used = time.time()
+        with self._lock:
+            if self.whisper_model is None:
+                self._load_whisper()
+            return self.whisper_model
+
+    def _load_whisper(self):
+        # Imported here, torch alone takes seconds to import.
+        try:
+            import whisper  # type: ignore
+        except ImportError:
+            raise RuntimeError("whisper package not installed")
+        model_name = self.ai_client.whisper_model_name
+        print(f"ℹ️ Loading Whisper model {model_name}")
+        logging.info("Loading Whisper model '%s'", model_name)
+        start = time.monotonic()
+        self.whisper_model = whisper.load_model(model_name, device=self.device)
+        self.loads += 1
+        print(f"✅ Loaded Whisper model {model_name} in {time.monotonic() - start:.1f}s, {_format_memory()}")
+        logging.info("Whisper model '%s' loaded, %s", model_name, _format_memory())
+
+    def touch_whisper(self):
+        self.whisper_used = time.time()
+
+    def touch_llm(self):
+        self.llm.used = time.time()
+        self.llm.loaded = True
+
+    def start(self):
+        """Start the idle unloader on the running loop, once."""
+        if self._task is not None or self.unload_timeout <= 0:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        interval = min(max(self.unload_timeout / 4, 1), 60)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.unload_idle()
+            except Exception as e:
+                print(f"⛔ Model unload failed: {e}")
+
+    async def unload_idle(self):
+        now = time.time()
+        # Clients sharing another client's transcription service leave Whisper to its owner.
+        owner = self.ai_client.transcription.ai_client is self.ai_client
+        if owner and now - self.whisper_used > self.unload_timeout:
+            await self.unload_whisper()
+        if self.llm.loaded and now - self.llm.used > self.unload_timeout:
+            await self.unload_ollama()
+
+    async def unload_whisper(self):
+        transcription = self.ai_client.transcription
+        if transcription.queue_depth():
+            return
+        unloaded = False
+        with self._lock:
+            if self.whisper_model is not None:
+                self.whisper_model = None
+                unloaded = True
+        if transcription.mode == "process" and transcription.running():
+            await transcription.close()
+            unloaded = True
+        if not unloaded:
+            return
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self.unloads += 1
+        print(f"ℹ️ Unloaded idle Whisper model, {_format_memory()}")
+        logging.info("Whisper model unloaded due to inactivity, %s", _format_memory())
+
+    async def unload_ollama(self):
+        # Cleared first, so the other clients of this backend do not unload it again.
+        self.llm.loaded = False
+        if not self.ai_client.use_ollama:
+            return
+        from ai_client import get_http_client
+
+        url = self.ai_client.ollama_url("/api/generate")
+        resp = await get_http_client().post(url, json={"model": self.ai_client.model, "keep_alive": 0})
+        resp.raise_for_status()
+        self.ollama_unloads += 1
+        print(f"ℹ️ Unloaded idle Ollama model {self.ai_client.model}")
+        logging.info("Ollama model '%s' unloaded due to inactivity", self.ai_client.model)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "whisper_loaded": self.whisper_model is not None,
+            "llm_loaded": self.llm.loaded,
+            "loads": self.loads,
+            "unloads": self.unloads,
+            "ollama_unloads": self.ollama_unloads,
+            "resident_bytes": resident_memory(),
+        }
@@ -0,0 +1,91 @@
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from image_utils import image_settings
+from config import getenv
+
+_executor = None
+_workers = 0
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor, _workers
+    if _executor is None:
+        _workers = int(getenv("PDF_WORKERS", min(4, os.cpu_count() or 1)))
+        # Spawned, not forked: by now the process runs the logging and to_thread threads.
+        context = multiprocessing.get_context("spawn")
+        _executor = ProcessPoolExecutor(max_workers=_workers, mp_context=context)
+    return _executor
+
+
+def pdf_settings() -> dict:
+    return {
+        "dpi": int(getenv("PDF_DPI", 100)),
+        "quality": int(getenv("PDF_JPEG_QUALITY", 80)),
+        "max_pages": int(getenv("PDF_MAX_PAGES", 20)),
+        "text_min_chars": int(getenv("PDF_TEXT_MIN_CHARS", 200)),
+        "max_edge": image_settings()["max_edge"],
+    }
+
+
+def extract_text(pdf_bytes: bytes, min_chars: int):
+    """Return (text, page_count); text is None when the PDF has no usable text layer."""
+    import fitz
+
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        pages = [page.get_text().strip() for page in doc]
+    total = sum(len(p) for p in pages)
+    if not pages or total / len(pages) < min_chars:
+        return None, len(pages)
+    return "\n\n".join(pages), len(pages)
+
+
+def render_pages(pdf_bytes: bytes, indices: list[int], dpi: int, quality: int, max_edge: int) -> list[bytes]:
+    import fitz
+
+    images = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for i in indices:
+            page = doc[i]
+            # Render straight at the size the image stage would downsize to.
+            zoom = min(dpi / 72, max_edge / max(page.rect.width, page.rect.height, 1))
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+            images.append(pix.tobytes(output="jpeg", jpg_quality=quality))
+    return images
+
+
+async def convert_pdf(pdf_bytes: bytes):
+    """Convert a PDF off the event loop.
+
+    PDFs with a real text layer are returned as text; others are rendered to
+    JPEG pages in parallel, up to PDF_MAX_PAGES pages.
+    Returns ("text", text) or ("pages", list of JPEG bytes in page order).
+    """
+    settings = pdf_settings()
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+
+    text, page_count = await loop.run_in_executor(
+        executor, extract_text, pdf_bytes, settings["text_min_chars"]
+    )
+    if text is not None:
+        print(f"ℹ️ Using text layer of {page_count}-page PDF")
+        return "text", text
+
+    count = min(page_count, settings["max_pages"])
+    if count < page_count:
+        print(f"ℹ️ Rendering only {count} of {page_count} PDF pages")
+    chunks = [list(range(count))[i::_workers] for i in range(_workers)]
+    chunks = [c for c in chunks if c]
+    results = await asyncio.gather(*[
+        loop.run_in_executor(
+            executor, render_pages, pdf_bytes, chunk, settings["dpi"], settings["quality"], settings["max_edge"]
+        )
+        for chunk in chunks
+    ])
+    pages = {}
+    for chunk, images in zip(chunks, results):
+        pages.update(zip(chunk, images))
+    print(f"✅ Rendered {len(pages)} PDF pages")
+    return "pages", [pages[i] for i in sorted(pages)]
@@ -1,9 +1,11 @@
 import os
 import sys
+import json
 import asyncio
 from dotenv import load_dotenv
 from pyrogram import Client
-from ai_client import AIClient
+from pyrogram.errors import FloodWait
+from ai_client import AIClient, get_http_client
 
 
 def get_prompts_dir() -> str:
@@ -24,6 +26,49 @@ def get_group_names_file() -> str:
     return os.path.join(get_group_prompts_dir(), "names.txt")
 
 
+def get_progress_file() -> str:
+    """Return path to the progress file of an interrupted bulk run."""
+    return os.path.join(get_prompts_dir(), "progress.json")
+
+
+def get_state_file() -> str:
+    """Return path to the per-user state of incremental prompt updates."""
+    return os.path.join(get_prompts_dir(), "state.json")
+
+
+def load_state() -> dict:
+    try:
+        with open(get_state_file(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_state(state: dict):
+    os.makedirs(get_prompts_dir(), exist_ok=True)
+    _write_atomic(get_state_file(), json.dumps(state, indent=1, sort_keys=True))
+
+
+def prompt_user_ids() -> list[int]:
+    """Return ids of users that already have a prompt file."""
+    prompts_dir = get_prompts_dir()
+    if not os.path.isdir(prompts_dir):
+        return []
+    ids = []
+    for f in os.listdir(prompts_dir):
+        stem, ext = os.path.splitext(f)
+        if ext == ".txt" and stem.isdigit():
+            ids.append(int(stem))
+    return sorted(ids)
+
+
+def _write_atomic(path: str, text: str):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
 def _load_name_pairs(path: str):
     pairs = {}
     names_file = path
@@ -39,9 +84,14 @@ def _load_name_pairs(path: str):
     return pairs
 
 
-async def update_names_file(client: Client, user_ids):
+async def update_names_file(client: Client, user_ids, known=None):
+    """Save names of ``user_ids``; names already in ``known`` are not looked up again."""
     pairs = _load_name_pairs(get_names_file())
+    known = known or {}
     for uid in user_ids:
+        if int(uid) in known:
+            pairs[int(uid)] = known[int(uid)]
+            continue
         user = await client.get_users(int(uid))
         name = user.first_name or user.username or str(uid)
         pairs[int(uid)] = name
@@ -49,9 +99,7 @@ async def update_names_file(client: Client, user_ids):
     prompts_dir = get_prompts_dir()
     names_file = get_names_file()
     os.makedirs(prompts_dir, exist_ok=True)
-    with open(names_file, "w", encoding="utf-8") as f:
-        for uid, name in sorted(pairs.items()):
-            f.write(f"{uid} - {name}\n")
+    _write_atomic(names_file, "".join(f"{uid} - {name}\n" for uid, name in sorted(pairs.items())))
     print(f"✅ Names saved to {names_file}")
 
 
@@ -65,21 +113,46 @@ async def update_group_names_file(client: Client, group_ids):
     prompts_dir = get_group_prompts_dir()
     names_file = get_group_names_file()
     os.makedirs(prompts_dir, exist_ok=True)
-    with open(names_file, "w", encoding="utf-8") as f:
-        for gid, name in sorted(pairs.items()):
-            f.write(f"{gid} - {name}\n")
+    _write_atomic(names_file, "".join(f"{gid} - {name}\n" for gid, name in sorted(pairs.items())))
     print(f"✅ Group names saved to {names_file}")
 
 
-async def generate_prompt(client: Client, user_id: int, api_type: str):
+def _load_prompt(user_id: int) -> str | None:
+    try:
+        with open(os.path.join(get_prompts_dir(), f"{user_id}.txt"), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+async def generate_prompt(client: Client, user_id: int, ai: AIClient, state: dict | None = None):
+    """Build the prompt of ``user_id`` and return ``(prompt, user_name, state)``.
+
+    ``state`` is what the previous run returned for the user: the id of the
+    newest message it read.  With a state and an existing prompt file only messages newer than that id are
+    read and the old prompt is updated with them; when there are none the
+    prompt is ``None`` and nothing is sent to the LLM.
+    """
+    old_prompt = _load_prompt(user_id) if state else None
+    last_id = state.get("last_message_id", 0) if old_prompt else 0
+    limit = int(os.getenv("PROMPT_HISTORY_LIMIT", 200))
     history = []
-    user = await client.get_users(user_id)
-    user_name = user.first_name or user.username or str(user_id)
-    async for m in client.get_chat_history(user_id, limit=200):
+    newest_id = last_id
+    # Newest first, so an unchanged chat costs a single request.
+    async for m in client.get_chat_history(user_id, limit=limit):
+        if m.id <= last_id:
+            break
+        newest_id = max(newest_id, m.id)
         if m.text or m.caption:
             history.append(m)
 
     history.reverse()
+    if not history:
+        new_state = dict(state or {}, last_message_id=newest_id)
+        return None, None, new_state
+
+    user = await client.get_users(user_id)
+    user_name = user.first_name or user.username or str(user_id)
     lines = []
     for m in history:
         role = os.getenv("MY_USER_NAME") if m.outgoing else user_name
@@ -87,23 +160,129 @@ async def generate_prompt(client: Client, user_id: int, api_type: str):
         lines.append(f"{role}: {text}")
     conversation = "\n".join(lines)
 
-    prompt_text = (
-        "Analyze the following message history and write a extended system prompt (return only prompt without any explanations) in Ukrainian language for LLM "
-        f"impersonating real man with real emotions (and not even suggest being artificial or a bot - it's important) {os.getenv('MY_USER_NAME')} conversation with {user_name}:\n\n" + conversation
-    )
+    new_state = {"last_message_id": newest_id}
 
-    print(f"ℹ️ Sending request to AI: {prompt_text}")
+    if old_prompt:
+        prompt_text = (
+            "Below is a system prompt (in Ukrainian language) for LLM impersonating real man with real emotions "
+            f"(and not even suggest being artificial or a bot - it's important) {os.getenv('MY_USER_NAME')} in conversation with {user_name}, "
+            "followed by the messages exchanged since it was written. Update the prompt with anything new these messages reveal, "
+            "keep everything that is still true and return only the full updated prompt without any explanations:\n\n"
+            f"{old_prompt}\n\nNew messages:\n\n{conversation}"
+        )
+    else:
+        prompt_text = (
+            "Analyze the following message history and write a extended system prompt (return only prompt without any explanations) in Ukrainian language for LLM "
+            f"impersonating real man with real emotions (and not even suggest being artificial or a bot - it's important) {os.getenv('MY_USER_NAME')} conversation with {user_name}:\n\n" + conversation
+        )
+
+    action = "Updating" if old_prompt else "Generating"
+    print(f"ℹ️ {action} prompt for {user_name} ({user_id}) from {len(history)} messages")
 
     messages = [{"role": "user", "content": prompt_text}]
-    ai = AIClient(api_type=api_type)
-    result = ai.complete(messages)
-    return result.strip(), user_name
+    result = await ai.acomplete(messages)
+    return result.strip(), user_name, new_state
+
+
+def save_prompt(user_id: int, text: str) -> str:
+    prompts_dir = get_prompts_dir()
+    os.makedirs(prompts_dir, exist_ok=True)
+    out_path = os.path.join(prompts_dir, f"{user_id}.txt")
+    _write_atomic(out_path, text)
+    return out_path
+
+
+def _load_progress(user_ids) -> set[int]:
+    """Return users finished by an interrupted run over the same users."""
+    try:
+        with open(get_progress_file(), "r", encoding="utf-8") as f:
+            progress = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return set()
+    if sorted(progress.get("users", [])) != sorted(user_ids):
+        return set()
+    return set(progress.get("done", []))
+
+
+def _save_progress(user_ids, done):
+    _write_atomic(get_progress_file(), json.dumps({"users": sorted(user_ids), "done": sorted(done)}))
+
+
+async def generate_prompts(client: Client, user_ids, ai: AIClient, concurrency: int | None = None, full: bool = False):
+    """Generate and save prompts for ``user_ids`` over one client, ``concurrency`` users at a time.
+
+    Users with a saved state are only updated from their new messages (see
+    :func:`generate_prompt`) unless ``full`` rebuilds them from scratch.
+
+    Finished users are recorded in the progress file after each prompt, so
+    running the same command again after an interruption or failures only
+    processes the users that are left.  The file is removed once all are done.
+    """
+    if concurrency is None:
+        concurrency = int(os.getenv("PROMPT_GEN_CONCURRENCY", 4))
+    user_ids = list(dict.fromkeys(int(u) for u in user_ids))
+    done = _load_progress(user_ids)
+    if done:
+        print(f"ℹ️ Resuming: {len(done)} of {len(user_ids)} prompts already generated")
+    pending = [u for u in user_ids if u not in done]
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    failed = []
+    unchanged = []
+    state = load_state()
+
+    async def run(user_id: int):
+        async with semaphore:
+            while True:
+                try:
+                    user_state = None if full else state.get(str(user_id))
+                    result, user_name, user_state = await generate_prompt(client, user_id, ai, user_state)
+                    break
+                except FloodWait as e:
+                    print(f"⏳ Telegram asks to wait {e.value}s before fetching {user_id}")
+                    await asyncio.sleep(e.value)
+                except Exception as e:
+                    print(f"⛔ Prompt for {user_id} failed: {e}")
+                    failed.append(user_id)
+                    return
+        if result is None:
+            unchanged.append(user_id)
+        else:
+            out_path = save_prompt(user_id, result)
+            await update_names_file(client, [user_id], known={user_id: user_name})
+            print(f"✅ Prompt saved to {out_path} ({len(done) + 1}/{len(user_ids)})")
+        # Saved after the prompt, so an interruption in between only repeats the update.
+        state[str(user_id)] = user_state
+        save_state(state)
+        done.add(user_id)
+        _save_progress(user_ids, done)
+
+    await asyncio.gather(*(run(u) for u in pending))
+    if unchanged:
+        print(f"ℹ️ {len(unchanged)} prompts unchanged, no new messages")
+    if failed:
+        print(f"⛔ {len(failed)} prompts failed, run the same command again to retry them: {failed}")
+    else:
+        try:
+            os.remove(get_progress_file())
+        except FileNotFoundError:
+            pass
+    return failed
+
+
+def parse_user_ids(arg: str) -> list[int]:
+    """Parse ``all``, a comma separated list of ids or ``@file`` with one id per line."""
+    if arg.lower() == "all":
+        return prompt_user_ids()
+    if arg.startswith("@"):
+        with open(arg[1:], "r", encoding="utf-8") as f:
+            return [int(line) for line in (line.strip() for line in f) if line.isdigit()]
+    return [int(u) for u in arg.split(",") if u.strip()]
 
 
 async def main():
     if len(sys.argv) < 3:
         print(
-            "Usage: python prompt_generator.py <instance> <prompt|names> [user_id] [openai|ollama]"
+            "Usage: python prompt_generator.py <instance> <prompt|names> [user_id[,user_id...]|@file|all] [openai|ollama]"
         )
         return
 
@@ -126,29 +305,27 @@ async def main():
 
     async with client:
         if mode == "prompt":
-            if len(sys.argv) != 5:
+            full = sys.argv[-1] == "--full"
+            if len(sys.argv) != 5 + full:
                 print(
-                    "Usage: python prompt_generator.py <instance> prompt <user_id> <openai|ollama>"
+                    "Usage: python prompt_generator.py <instance> prompt <user_id[,user_id...]|@file|all> <openai|ollama> [--full]"
                 )
                 return
-            user_id = int(sys.argv[3])
+            user_ids = parse_user_ids(sys.argv[3])
             api_type = sys.argv[4].lower()
             if api_type not in {"openai", "ollama"}:
                 print("API type must be 'openai' or 'ollama'")
                 return
+            if not user_ids:
+                print("No users to generate prompts for")
+                return
 
-            result, user_name = await generate_prompt(client, user_id, api_type)
-
-            prompts_dir = get_prompts_dir()
-            os.makedirs(prompts_dir, exist_ok=True)
-            out_path = os.path.join(prompts_dir, f"{user_id}.txt")
-            with open(out_path, "w", encoding="utf-8") as f:
-                f.write(result)
-
-            print(f"ℹ️ AI returned prompt: {result}")
-            print(f"✅ Prompt saved to {out_path}")
-
-            await update_names_file(client, [user_id])
+            ai = AIClient(api_type=api_type)
+            try:
+                await generate_prompts(client, user_ids, ai, full=full)
+            finally:
+                await ai.models.close()
+                await get_http_client().aclose()
         else:  # names
             prompts_dir = get_prompts_dir()
             os.makedirs(prompts_dir, exist_ok=True)
@@ -0,0 +1,114 @@
+import os
+import time
+import asyncio
+from config import getenv
+
+
+class PromptStore:
+    """In-memory cache of per-chat prompt files, including chats without a file.
+
+    Entries are revalidated by file mtime at most every ``check_interval``
+    seconds.  With ``watch_interval`` set, a background task scans the prompt
+    directories instead and lookups never touch the disk.
+    """
+
+    def __init__(self, check_interval: float | None = None, watch_interval: float | None = None):
+        if check_interval is None:
+            check_interval = float(getenv("PROMPT_CHECK_INTERVAL", 30))
+        if watch_interval is None:
+            watch_interval = float(getenv("PROMPT_WATCH_INTERVAL", 0))
+        self.check_interval = check_interval
+        self.watch_interval = watch_interval
+        self._entries = {}
+        self._watcher = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _mtime(path: str):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self, path: str, mtime):
+        text = None
+        if mtime is not None:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    text = f.read().strip()
+            except FileNotFoundError:
+                mtime = None
+        self._entries[path] = {"text": text, "mtime": mtime, "checked": time.monotonic()}
+        return text
+
+    def get(self, path: str) -> str | None:
+        """Return the stripped file content, or None when the file does not exist."""
+        self._ensure_watcher()
+        entry = self._entries.get(path)
+        if entry is not None:
+            if self._watcher is not None or time.monotonic() - entry["checked"] < self.check_interval:
+                self.hits += 1
+                return entry["text"]
+            mtime = self._mtime(path)
+            if mtime == entry["mtime"]:
+                entry["checked"] = time.monotonic()
+                self.hits += 1
+                return entry["text"]
+            self.invalidations += 1
+        else:
+            mtime = self._mtime(path)
+        self.misses += 1
+        return self._load(path, mtime)
+
+    def invalidate(self, path: str | None = None):
+        if path is None:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+        elif self._entries.pop(path, None) is not None:
+            self.invalidations += 1
+
+    def _ensure_watcher(self):
+        if self._watcher is not None or self.watch_interval <= 0:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._watcher = asyncio.create_task(self._watch())
+
+    @staticmethod
+    def _scan(directories) -> dict:
+        current = {}
+        for directory in directories:
+            try:
+                with os.scandir(directory) as it:
+                    for item in it:
+                        if item.is_file():
+                            current[item.path] = item.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+        return current
+
+    async def _watch(self):
+        print(f"ℹ️ Watching prompt files every {self.watch_interval:g}s")
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                directories = {os.path.dirname(p) for p in self._entries}
+                current = await asyncio.to_thread(self._scan, directories)
+            except Exception as e:
+                print(f"⛔ Prompt watcher error: {e}")
+                continue
+            for path, entry in list(self._entries.items()):
+                if current.get(path) != entry["mtime"]:
+                    self.invalidate(path)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
@@ -1,32 +1,55 @@
 import json
+import asyncio
 from datetime import datetime
 import os
 import time
 import requests
+from config import getenv
 
 
-current_weather = ""
+# Last known weather per instance, keyed by its weather cache path.
+_weather: dict[str, str] = {}
 
+WEATHER_CACHE_TTL = 3 * 3600
 
-def update_weather() -> None:
+
+def get_weather_path() -> str:
+    return os.path.join("data", getenv("INSTANCE_NAME", "default"), "weather.txt")
+
+
+def current_weather() -> str:
+    return _weather.get(get_weather_path(), "")
+
+
+def load_cached_weather(max_age: float | None = None) -> bool:
+    """Serve weather from the file cache; any age is accepted when max_age is None."""
+    path = get_weather_path()
+    if not os.path.exists(path):
+        return False
+    if max_age is not None and time.time() - os.path.getmtime(path) >= max_age:
+        return False
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            _weather[path] = f.read().strip()
+        return True
+    except Exception:
+        return False
+
+
+def update_weather(max_age: float = WEATHER_CACHE_TTL) -> bool:
+    """Refresh the current weather, keeping the last good value when the API fails."""
     print(f"ℹ️ Weather update started")
 
-    global current_weather
-    lat = os.getenv("WEATHER_LAT")
-    lon = os.getenv("WEATHER_LON")
-    api_key = os.getenv("OPENWEATHER_API_KEY")
+    path = get_weather_path()
+    lat = getenv("WEATHER_LAT")
+    lon = getenv("WEATHER_LON")
+    api_key = getenv("OPENWEATHER_API_KEY")
     if not (lat and lon and api_key):
-        current_weather = ""
-        return
-
-    path = os.path.join("data", os.getenv("INSTANCE_NAME", "default"), "weather.txt")
-    if os.path.exists(path) and time.time() - os.path.getmtime(path) < 3 * 3600:
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                current_weather = f.read().strip()
-            return
-        except Exception:
-            pass
+        _weather[path] = ""
+        return True
+
+    if load_cached_weather(max_age):
+        return True
 
     try:
         url = (
@@ -42,22 +65,49 @@ def update_weather() -> None:
 
         temp = data["main"]["temp"]
         desc = data["weather"][0]["description"]
-        current_weather = f"{temp}°C, {desc}"
+        weather = f"{temp}°C, {desc}"
+        _weather[path] = weather
 
-        print(f"ℹ️ Got weather from API: {current_weather}")
+        print(f"ℹ️ Got weather from API: {weather}")
 
         os.makedirs(os.path.dirname(path), exist_ok=True)
         with open(path, "w", encoding="utf-8") as f:
-            f.write(current_weather)
+            f.write(weather)
+        return True
     except Exception as e:
-        current_weather = ""
         print(f"⛔ Weather update failed: {e}")
+        return False
 
 
-def enhance_system_prompt(prompt: str) -> str:
+async def refresh_weather_periodically(interval: float | None = None, retry: float | None = None):
+    """Keep the current weather fresh from inside the bot's event loop, backing off on failures."""
+    if interval is None:
+        interval = float(getenv("WEATHER_REFRESH_INTERVAL", 3600))
+    if retry is None:
+        retry = float(getenv("WEATHER_RETRY_INTERVAL", 60))
+    failures = 0
+    while True:
+        if await asyncio.to_thread(update_weather, interval):
+            failures = 0
+            delay = interval
+        else:
+            failures += 1
+            delay = min(interval, retry * 2 ** (failures - 1))
+            print(f"ℹ️ Retrying weather update in {delay:.0f}s")
+        await asyncio.sleep(delay)
+
+
+_time_context = ("", "")
+
+
+def get_time_context() -> str:
+    """Return the date and time sentence, rebuilt at most once per minute."""
+    global _time_context
     now = datetime.now()
+    time_str = now.strftime("%Y-%m-%d %H:%M")
+    if _time_context[0] == time_str:
+        return _time_context[1]
     date_str = now.strftime("%Y-%m-%d")
-    time_str = now.strftime("%H:%M")
     hour = now.hour
     if 5 <= hour < 12:
         period = "morning"
@@ -67,10 +117,20 @@ def enhance_system_prompt(prompt: str) -> str:
         period = "evening"
     else:
         period = "night"
-    result = (
-        f"{prompt}\nIf your answer is related to daytime, use this info Current date: {date_str}. Current time: {time_str}. It's {period}."
-    )
-    if current_weather:
-        result += f"\nIf your answer is related to weather, use this info Current weather: {current_weather}."
+    text = f"If your answer is related to daytime, use this info Current date: {date_str}. Current time: {now.strftime('%H:%M')}. It's {period}."
+    _time_context = (time_str, text)
+    return text
+
+
+def get_volatile_context() -> str:
+    """Date, time and weather sentences that change between turns."""
+    result = get_time_context()
+    weather = current_weather()
+    if weather:
+        result += f"\nIf your answer is related to weather, use this info Current weather: {weather}."
     return result
 
+
+def enhance_system_prompt(prompt: str) -> str:
+    return f"{prompt}\n{get_volatile_context()}"
+
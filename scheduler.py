@@ -0,0 +1,199 @@
+import asyncio
+from config import getenv
+
+
+class Job:
+    """A batch handed to the handler. Once committed, the reply is being sent and
+    the batch can no longer be restarted.
+
+    The handler calls ``generating`` right before the LLM request.  Only from
+    then on is the batch restarted at once; newer messages that arrive while
+    history and media are still being converted wait until that point, so a
+    restart never throws away a transcription, download or PDF rendering.
+    """
+
+    def __init__(self, messages, reply_to, first_at: float, on_generating=None):
+        self.messages = messages
+        self.reply_to = reply_to
+        self.first_at = first_at
+        self.committed = False
+        self.restarted = False
+        self.late = False
+        self.started = False
+        self.restart_pending = False
+        self._on_generating = on_generating
+
+    def generating(self):
+        """Mark the start of the LLM request; raises CancelledError if newer messages restart the batch."""
+        self.started = True
+        if self.restart_pending and self._on_generating is not None and self._on_generating():
+            raise asyncio.CancelledError()
+
+    def commit(self):
+        self.committed = True
+
+
+class _Mailbox:
+    def __init__(self):
+        self.messages = []
+        self.reply_to = None
+        self.delay = None
+        self.first_at = None
+        self.deadline = None
+        self.wake = asyncio.Event()
+        self.worker = None
+        self.job = None
+        self.task = None
+
+
+class ChatScheduler:
+    """One mailbox and one worker task per chat_key.
+
+    Every new message resets the debounce timer of its chat, but a batch is
+    never held longer than ``max_wait`` seconds after its first message.
+    Batches of the same chat are processed one after another by its worker,
+    while different chats do not wait for each other.
+
+    When a message arrives while the previous batch is still generating, the
+    generation is cancelled and restarted with both batches merged, keeping
+    the first message time of the batch, so ``max_wait`` still bounds it.
+    Once that has passed the batch is no longer restarted and the reply is
+    counted as late instead.
+    """
+
+    def __init__(self, handler, max_wait: float | None = None, restart: bool | None = None):
+        self.handler = handler
+        if max_wait is None:
+            max_wait = float(getenv("MESSAGE_MAX_WAIT", 120))
+        if restart is None:
+            restart = getenv("RESTART_ON_NEW_MESSAGE", "true").lower() in ["1", "true", "yes"]
+        self.max_wait = max_wait
+        self.restart = restart
+        self._mailboxes: dict = {}
+        self.restarts = 0
+        self.late_replies = 0
+
+    def submit(self, chat_key, message, delay: float, reply_target: bool = False) -> bool:
+        """Queue a message and return True when it starts a new batch."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        box = self._mailboxes.get(chat_key)
+        if box is None:
+            box = _Mailbox()
+            self._mailboxes[chat_key] = box
+            box.worker = asyncio.create_task(self._run(chat_key, box))
+
+        new_batch = not box.messages
+        job = box.job
+        if job is not None and not job.restarted:
+            if self._can_restart(job, now):
+                if job.started:
+                    self._restart(chat_key, box)
+                else:
+                    # Restarted once the batch reaches the LLM, see Job.generating.
+                    job.restart_pending = True
+            elif not job.late:
+                # The reply to the previous batch no longer covers everything the chat said.
+                job.late = True
+                self.late_replies += 1
+        if not box.messages:
+            box.first_at = now
+        box.delay = delay if box.delay is None else min(box.delay, delay)
+        box.messages.append(message)
+        if reply_target:
+            box.reply_to = message
+        box.deadline = min(now + box.delay, box.first_at + self.max_wait)
+        box.wake.set()
+        return new_batch
+
+    def _can_restart(self, job: Job, now: float) -> bool:
+        return self.restart and not job.committed and now < job.first_at + self.max_wait
+
+    def _restart(self, chat_key, box: _Mailbox, cancel: bool = True):
+        """Merge the running batch back into the mailbox, keeping its first message time."""
+        job = box.job
+        job.restarted = True
+        if cancel:
+            box.task.cancel()
+        box.messages = job.messages + box.messages
+        if box.reply_to is None:
+            box.reply_to = job.reply_to
+        box.first_at = job.first_at
+        if box.deadline is not None:
+            box.deadline = min(box.deadline, box.first_at + self.max_wait)
+        self.restarts += 1
+        print(f"ℹ️ Restarting generation for {chat_key} with new messages")
+
+    def _generating(self, chat_key, box: _Mailbox) -> bool:
+        """Run a pending restart when the batch reaches the LLM; True if it was restarted."""
+        job = box.job
+        now = asyncio.get_running_loop().time()
+        if box.messages and self._can_restart(job, now):
+            # The caller raises CancelledError itself instead of being cancelled.
+            self._restart(chat_key, box, cancel=False)
+            return True
+        if box.messages and not job.late:
+            job.late = True
+            self.late_replies += 1
+        return False
+
+    def queue_depth(self, chat_key=None) -> int:
+        if chat_key is not None:
+            box = self._mailboxes.get(chat_key)
+            return len(box.messages) if box else 0
+        return sum(len(box.messages) for box in self._mailboxes.values())
+
+    def active_chats(self) -> int:
+        return len(self._mailboxes)
+
+    async def _wait_deadline(self, box: _Mailbox):
+        loop = asyncio.get_running_loop()
+        while True:
+            remaining = box.deadline - loop.time()
+            if remaining <= 0:
+                return
+            box.wake.clear()
+            try:
+                await asyncio.wait_for(box.wake.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, chat_key, box: _Mailbox):
+        try:
+            while box.messages:
+                await self._wait_deadline(box)
+                box.job = Job(
+                    box.messages, box.reply_to, box.first_at,
+                    on_generating=lambda key=chat_key, b=box: self._generating(key, b),
+                )
+                box.messages, box.reply_to = [], None
+                box.delay, box.deadline = None, None
+                box.task = asyncio.create_task(self.handler(chat_key, box.job))
+                try:
+                    await box.task
+                    if box.job.restart_pending and not box.job.restarted and not box.job.late:
+                        # Newer messages came in but the batch never reached the LLM.
+                        box.job.late = True
+                        self.late_replies += 1
+                except asyncio.CancelledError:
+                    if not box.job.restarted:
+                        raise
+                except Exception as e:
+                    print(f"⛔ Unexpected error while processing {chat_key}: {e}")
+                finally:
+                    box.job, box.task = None, None
+        finally:
+            if self._mailboxes.get(chat_key) is box:
+                del self._mailboxes[chat_key]
+
+    def stats(self) -> dict:
+        waiting = [key for key, box in self._mailboxes.items() if box.messages]
+        return {
+            "active_chats": self.active_chats(),
+            "waiting_users": sum(1 for key in waiting if not isinstance(key, tuple)),
+            "waiting_groups": sum(1 for key in waiting if isinstance(key, tuple)),
+            "generating": sum(1 for box in self._mailboxes.values() if box.job is not None),
+            "queued_messages": self.queue_depth(),
+            "restarts": self.restarts,
+            "late_replies": self.late_replies,
+        }
@@ -0,0 +1,86 @@
+import os
+import time
+import sqlite3
+from config import getenv
+
+
+class TranscriptCache:
+    """Persistent transcripts keyed by file_unique_id and Whisper model name.
+
+    Entries live in a small SQLite database and the least recently used ones
+    are dropped once ``max_entries`` is exceeded.  Access times of hits are
+    collected in memory and written with the next ``put``, every
+    ``TOUCH_BATCH`` hits or by ``flush``, so a hit does not commit on the loop.
+    """
+
+    TOUCH_BATCH = 64
+
+    def __init__(self, path: str, max_entries: int | None = None):
+        if max_entries is None:
+            max_entries = int(getenv("TRANSCRIPT_CACHE_MAX_ENTRIES", 10000))
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._touched: dict[tuple, float] = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS transcripts ("
+            "uid TEXT NOT NULL, model TEXT NOT NULL, text TEXT NOT NULL, "
+            "last_access REAL NOT NULL, PRIMARY KEY (uid, model))"
+        )
+        self._db.commit()
+
+    def get(self, uid: str, model: str) -> str | None:
+        row = self._db.execute(
+            "SELECT text FROM transcripts WHERE uid = ? AND model = ?", (uid, model)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched[(uid, model)] = time.time()
+        if len(self._touched) >= self.TOUCH_BATCH:
+            self.flush()
+        return row[0]
+
+    def _write_touched(self):
+        if self._touched:
+            self._db.executemany(
+                "UPDATE transcripts SET last_access = ? WHERE uid = ? AND model = ?",
+                [(t, uid, model) for (uid, model), t in self._touched.items()],
+            )
+            self._touched = {}
+
+    def flush(self):
+        """Write the collected access times."""
+        if self._touched:
+            self._write_touched()
+            self._db.commit()
+
+    def put(self, uid: str, model: str, text: str):
+        # Eviction below orders by last_access, so pending hits are written first.
+        self._write_touched()
+        self._db.execute(
+            "INSERT OR REPLACE INTO transcripts (uid, model, text, last_access) VALUES (?, ?, ?, ?)",
+            (uid, model, text, time.time()),
+        )
+        self._db.execute(
+            "DELETE FROM transcripts WHERE rowid IN ("
+            "SELECT rowid FROM transcripts ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self._db.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        entries = self._db.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
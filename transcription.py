@@ -0,0 +1,143 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from config import getenv
+
+_worker_model = None
+
+
+def _init_process_worker(model_name: str, device: str | None):
+    global _worker_model
+    import whisper
+
+    _worker_model = whisper.load_model(model_name, device=device)
+    logging.info("Whisper model '%s' loaded in worker %s", model_name, os.getpid())
+
+
+def _transcribe_in_process(audio_bytes: bytes) -> str:
+    from ai_client import decode_audio
+
+    result = _worker_model.transcribe(audio=decode_audio(audio_bytes))
+    return result.get("text", "").strip()
+
+
+class TranscriptionService:
+    """Runs Whisper off the event loop through a bounded job queue.
+
+    ``TRANSCRIBE_EXECUTOR=thread`` shares the model of the owning AIClient
+    with a single worker, ``process`` loads one model per worker process.  Audio is always passed
+    as bytes, nothing is written to disk.  In host mode, the AIClients of all
+    instances share the service of the first one.
+    """
+
+    def __init__(self, ai_client, mode=None, workers=None, queue_size=None, timeout=None):
+        self.ai_client = ai_client
+        self.mode = (mode or getenv("TRANSCRIBE_EXECUTOR", "thread")).lower()
+        if self.mode not in {"thread", "process"}:
+            raise ValueError(f"Unknown TRANSCRIBE_EXECUTOR '{self.mode}'")
+        self.workers = workers or int(getenv("TRANSCRIBE_WORKERS", 1))
+        if self.mode == "thread" and self.workers > 1:
+            # Whisper installs kv-cache hooks on the model for every decode, so
+            # concurrent transcriptions on one shared model corrupt each other.
+            print("⚠️ TRANSCRIBE_WORKERS > 1 needs TRANSCRIBE_EXECUTOR=process, using 1 thread worker")
+            self.workers = 1
+        self.queue_size = queue_size or int(getenv("TRANSCRIBE_QUEUE_SIZE", 32))
+        self.timeout = timeout or float(getenv("TRANSCRIBE_TIMEOUT", 300))
+        self.model_name = getenv("WHISPER_MODEL", "turbo")
+        self.device = getenv("WHISPER_DEVICE")
+        self._queue = None
+        self._executor = None
+        self._tasks = []
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    def _start(self):
+        if self._queue is not None:
+            return
+        if self.mode == "process":
+            # Like the PDF pool, spawned so no thread state of this process is copied.
+            context = multiprocessing.get_context("spawn")
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_init_process_worker,
+                initargs=(self.model_name, self.device),
+            )
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="whisper")
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        print(f"ℹ️ Transcription service started: {self.workers} {self.mode} worker(s)")
+
+    def _job(self, audio_bytes: bytes):
+        if self.mode == "process":
+            return _transcribe_in_process, audio_bytes
+        return self.ai_client.transcribe, audio_bytes
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            audio_bytes, future = await self._queue.get()
+            try:
+                if future.done():
+                    # The caller already gave up on this job.
+                    continue
+                func, arg = self._job(audio_bytes)
+                try:
+                    result = await loop.run_in_executor(self._executor, func, arg)
+                except Exception as e:
+                    self.failed += 1
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    self.completed += 1
+                    if not future.done():
+                        future.set_result(result)
+            finally:
+                self._queue.task_done()
+
+    def running(self) -> bool:
+        return self._executor is not None
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def transcribe(self, audio_bytes: bytes, timeout: float | None = None) -> str:
+        """Queue a clip and wait for its transcript, raising TimeoutError after ``timeout``."""
+        self._start()
+        if timeout is None:
+            timeout = self.timeout
+        future = asyncio.get_running_loop().create_future()
+
+        async def submit():
+            await self._queue.put((audio_bytes, future))
+            return await future
+
+        try:
+            return await asyncio.wait_for(submit(), timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            future.cancel()
+            raise TimeoutError(f"Transcription timed out after {timeout:.0f}s")
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._queue = None
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "queued": self.queue_depth(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+        }
@@ -1,13 +1,21 @@
 import os
 import sys
 import glob
+import json
 import subprocess
 import time
+from collections import deque
 import streamlit as st
 
 LOG_DIR = "logs"
 os.makedirs(LOG_DIR, exist_ok=True)
 
+# Lines kept on screen per instance and lines between two entries of the offset index.
+VIEW_LINES = int(os.getenv("UI_LOG_LINES", 500))
+INDEX_EVERY = 1000
+CHUNK_BYTES = 1 << 20
+REFRESH_SECONDS = float(os.getenv("UI_REFRESH_SECONDS", 2))
+
 
 def list_instances():
     files = glob.glob(".env.*")
@@ -19,62 +27,226 @@ def list_instances():
     return sorted(names)
 
 
-def read_new(filepath: str, pos: int):
-    """Return new log data from pos and new position."""
+class LogTail:
+    """Follows a log file, keeping only the last ``maxlen`` lines in memory.
+
+    Every ``INDEX_EVERY`` lines the byte offset of the next line is recorded,
+    so older parts of the file can be read back with :meth:`page` without
+    holding or rescanning the whole log.  A shrinking file means it was rotated
+    and the tail starts over.
+    """
+
+    def __init__(self, path: str, maxlen: int = VIEW_LINES):
+        self.path = path
+        self.lines = deque(maxlen=maxlen)
+        self.index = [0]
+        self.pos = 0
+        self.line_count = 0
+
+    def reset(self):
+        self.lines.clear()
+        self.index = [0]
+        self.pos = 0
+        self.line_count = 0
+
+    def poll(self) -> int:
+        """Read lines appended since the last poll and return how many there were."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return 0
+        if size < self.pos:
+            self.reset()
+        if size == self.pos:
+            return 0
+        added = 0
+        with open(self.path, "rb") as f:
+            f.seek(self.pos)
+            while self.pos < size:
+                data = f.read(min(CHUNK_BYTES, size - self.pos))
+                # A partly written last line is read again on the next poll.
+                end = data.rfind(b"\n") + 1
+                if not end:
+                    break
+                for raw in data[:end].splitlines(keepends=True):
+                    self.pos += len(raw)
+                    self.lines.append(raw.decode("utf-8", errors="replace").rstrip("\n"))
+                    self.line_count += 1
+                    added += 1
+                    if self.line_count % INDEX_EVERY == 0:
+                        self.index.append(self.pos)
+                f.seek(self.pos)
+        return added
+
+    def page(self, number: int) -> list[str]:
+        """Lines ``number * INDEX_EVERY`` to ``(number + 1) * INDEX_EVERY`` of the file."""
+        if not 0 <= number < len(self.index):
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self.index[number])
+            lines = []
+            while len(lines) < INDEX_EVERY and f.tell() < self.pos:
+                lines.append(f.readline().decode("utf-8", errors="replace").rstrip("\n"))
+        return lines
+
+
+def read_metrics(instance: str):
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            f.seek(pos)
-            data = f.read()
-            return data, f.tell()
-    except FileNotFoundError:
-        return "", pos
-
-
-if "process" not in st.session_state:
-    st.session_state.process = None
-if "logfile" not in st.session_state:
-    st.session_state.logfile = None
-if "log_pos" not in st.session_state:
-    st.session_state.log_pos = 0
-if "log_text" not in st.session_state:
-    st.session_state.log_text = ""
+        with open(os.path.join("data", instance, "metrics.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+@st.cache_resource
+def processes() -> dict:
+    """Processes started from the UI, shared by every browser session."""
+    return {}
+
+
+def process_of(instance: str):
+    proc = processes().get(instance)
+    if proc is not None and proc.poll() is not None:
+        return None
+    return proc
+
+
+def start_instance(instance: str):
+    if process_of(instance) is not None:
+        return
+    # The bot writes logs/<instance>.log itself, so its console logging is turned
+    # off; stderr is kept for tracebacks of crashes before logging is set up.
+    out = open(os.path.join(LOG_DIR, f"{instance}.out"), "a", encoding="utf-8")
+    env = dict(os.environ, LOG_CONSOLE="false")
+    processes()[instance] = subprocess.Popen(
+        [sys.executable, "app.py", instance], stdout=subprocess.DEVNULL, stderr=out, env=env
+    )
+    out.close()
+
+
+def stop_instance(instance: str):
+    proc = processes().pop(instance, None)
+    if proc is not None and proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def instance_status(instance: str) -> dict:
+    proc = processes().get(instance)
+    snapshot = read_metrics(instance)
+    if proc is None:
+        state = "stopped"
+    elif proc.poll() is None:
+        state = "running"
+    else:
+        state = f"exited ({proc.returncode})"
+    status = {"instance": instance, "state": state, "pid": proc.pid if proc else None}
+    if snapshot:
+        counters = snapshot.get("counters", {})
+        scheduler = snapshot.get("gauges", {}).get("scheduler", {})
+        status.update({
+            "metrics age (s)": round(time.time() - snapshot["time"]),
+            "replies": counters.get("replies", 0),
+            "errors": counters.get("reply_errors", 0),
+            "waiting": scheduler.get("waiting_users", 0) + scheduler.get("waiting_groups", 0),
+        })
+    return status
+
+
+def show_metrics(instance: str):
+    snapshot = read_metrics(instance)
+    if snapshot is None:
+        return
+    history = st.session_state.metrics_history.setdefault(instance, [])
+    if not history or history[-1]["time"] != snapshot["time"]:
+        history.append(snapshot)
+        del history[:-120]
+
+    counters = snapshot.get("counters", {})
+    scheduler = snapshot.get("gauges", {}).get("scheduler", {})
+    cols = st.columns(4)
+    cols[0].metric("Replies", counters.get("replies", 0))
+    cols[1].metric("Errors", counters.get("reply_errors", 0))
+    cols[2].metric("Waiting users", scheduler.get("waiting_users", 0))
+    cols[3].metric("Waiting groups", scheduler.get("waiting_groups", 0))
+
+    chart = {}
+    for point in history:
+        for name, span in point.get("spans", {}).items():
+            chart.setdefault(name, []).append(span.get("p50_ms", 0.0))
+    if chart:
+        length = min(len(v) for v in chart.values())
+        st.line_chart({name: values[-length:] for name, values in chart.items()})
+    with st.expander("Metrics snapshot"):
+        st.json(snapshot)
+
+
+def get_tail(instance: str) -> LogTail:
+    tails = st.session_state.tails
+    if instance not in tails:
+        tails[instance] = LogTail(os.path.join(LOG_DIR, f"{instance}.log"))
+    return tails[instance]
+
+
+# Reruns only the live parts of the page when fragments are available.
+live = st.fragment(run_every=REFRESH_SECONDS) if hasattr(st, "fragment") else (lambda func: func)
+
+
+@live
+def show_status(instances):
+    st.dataframe([instance_status(name) for name in instances], hide_index=True, use_container_width=True)
+
+
+@live
+def show_live(instance: str):
+    show_metrics(instance)
+    tail = get_tail(instance)
+    tail.poll()
+    st.caption(f"Last {len(tail.lines)} of {tail.line_count} lines")
+    st.code("\n".join(tail.lines), language=None)
+
+
+if "metrics_history" not in st.session_state:
+    st.session_state.metrics_history = {}
+if "tails" not in st.session_state:
+    st.session_state.tails = {}
 
 st.title("VictorGram Manager")
 instances = list_instances()
-selected = st.selectbox("Instance", instances)
 
 col1, col2 = st.columns(2)
-if col1.button("Start"):
-    if st.session_state.process is None:
-        log_path = os.path.join(LOG_DIR, f"{selected}.log")
-        log_file = open(log_path, "a", encoding="utf-8")
-        proc = subprocess.Popen([sys.executable, "app.py", selected], stdout=log_file, stderr=log_file)
-        st.session_state.process = proc
-        st.session_state.logfile = log_path
-        st.session_state.log_pos = 0
-        st.session_state.log_text = ""
-
-if col2.button("Stop"):
-    if st.session_state.process is not None:
-        st.session_state.process.terminate()
-        st.session_state.process.wait()
-        st.session_state.process = None
-
-log_placeholder = st.empty()
-
-if st.session_state.logfile:
-    new_data, st.session_state.log_pos = read_new(
-        st.session_state.logfile, st.session_state.log_pos
-    )
-    if new_data:
-        st.session_state.log_text += new_data
+if col1.button("Start all"):
+    for name in instances:
+        start_instance(name)
+if col2.button("Stop all"):
+    for name in instances:
+        stop_instance(name)
 
-    html = (
-        "<div style='height:500px; overflow-y:auto; font-family:monospace; "
-        "white-space: pre-wrap;'>" + st.session_state.log_text + "</div>"
-    )
-    log_placeholder.markdown(html, unsafe_allow_html=True)
-    time.sleep(1)
+show_status(instances)
+
+selected = st.selectbox("Instance", instances)
+if selected:
+    col1, col2 = st.columns(2)
+    running = process_of(selected) is not None
+    if col1.button("Start", disabled=running):
+        start_instance(selected)
+    if col2.button("Stop", disabled=not running):
+        stop_instance(selected)
+
+    show_live(selected)
+
+    tail = get_tail(selected)
+    with st.expander("History"):
+        number = st.number_input(
+            f"Page of {INDEX_EVERY} lines", min_value=0, max_value=max(len(tail.index) - 1, 0), value=0
+        )
+        st.code("\n".join(tail.page(int(number))), language=None)
+
+if not hasattr(st, "fragment"):
+    time.sleep(REFRESH_SECONDS)
     if hasattr(st, "experimental_rerun"):
         st.experimental_rerun()
     else: